@@ -0,0 +1,107 @@
+'''
+Iterations per second and loss curves of fp32 and bf16 training (opt.precision)
+with the nets of DCGAN-MNIST (mnistnet_G/D, 1 x 32 x 32) and of deletions.py
+(deletionsnet.LINnet_G/D, conditioned on 41 genes and 34 deletions, 2 x 48 x 128),
+batch 64, Adam 2e-4. Both precisions start from the same weights and see the same
+batches, drawn from a fixed pool of random images (with random gene and deletion
+labels for deletions.py), so the loss curves can be compared window by window.
+
+    python benchmark_precision.py --config mnist --num_iter 300
+'''
+import argparse
+import tempfile
+
+import numpy as np
+
+import torch
+from torch import optim
+from torch.autograd import Variable
+
+import gan
+import mnistnet
+import deletionsnet
+
+from metrics import read_metrics
+
+
+CONFIGS = {
+    'mnist': dict(shape=(1, 32, 32), batch_size=64, two_labels=False,
+                  make_nets=lambda: (mnistnet.mnistnet_G(nc=1, nz=100), mnistnet.mnistnet_D(nc=1))),
+    'deletions': dict(shape=(2, 48, 128), batch_size=64, two_labels=True,
+                      make_nets=lambda: (deletionsnet.LINnet_G(nc=2, nz=100, n_gens=41, n_deletions=34),
+                                         deletionsnet.LINnet_D(nc=2, BN=True, n_gens=41, n_deletions=34))),
+}
+
+
+def batches(pool, batch_size, seed, two_labels=False, n_classes1=41, n_classes2=34):
+    rng = np.random.RandomState(seed)
+    while True:
+        x = Variable(pool[torch.from_numpy(rng.randint(0, len(pool), size=batch_size))])
+        if not two_labels:
+            yield x
+        else:
+            y1 = Variable(torch.from_numpy(rng.randint(0, n_classes1, size=batch_size)))
+            y2 = Variable(torch.from_numpy(rng.randint(0, n_classes2, size=batch_size)))
+            yield x, y1, y2
+
+
+def run(config, precision, num_iter, seed=0):
+    '''trains config for num_iter iterations, returns its metrics (see metrics.read_metrics)'''
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    netG, netD = config['make_nets']()
+
+    opt = gan.Options()
+    opt.precision = precision
+    opt.path = tempfile.mkdtemp() + '/'
+    opt.num_iter = num_iter
+    opt.batch_size = config['batch_size']
+    opt.nz = (100, 1, 1)
+    opt.num_disc_iters = 1
+    opt.conditionalD = False
+    opt.state_every = num_iter + 1
+    opt.two_labels = config['two_labels']
+    opt.n_classes1 = 41
+    opt.n_classes2 = 34
+
+    pool = torch.rand((1024,) + config['shape']) * 2 - 1
+
+    optimizerD = optim.Adam(netD.parameters(), lr=2e-4, betas=(.5, .999))
+    optimizerG = optim.Adam(netG.parameters(), lr=2e-4, betas=(.5, .999))
+
+    gan1 = gan.GAN(netG=netG, netD=netD, optimizerD=optimizerD, optimizerG=optimizerG, opt=opt)
+    gan1.train(batches(pool, opt.batch_size, seed, opt.two_labels, opt.n_classes1, opt.n_classes2), opt)
+
+    return np.array(read_metrics(opt.path + 'metrics.bin'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='mnist', choices=sorted(CONFIGS))
+    parser.add_argument('--num_iter', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20, help='iterations left out of the timing')
+    parser.add_argument('--window', type=int, default=50, help='iterations per loss curve point')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    gan.TENSORBOARD = False
+
+    results = {precision: run(CONFIGS[args.config], precision, args.num_iter) for precision in ['fp32', 'bf16']}
+
+    print('\n{}, {} threads'.format(args.config, torch.get_num_threads()))
+    speed = {}
+    for precision, m in results.items():
+        t = m['time']
+        speed[precision] = (len(t) - 1 - args.warmup) / (t[-1] - t[args.warmup])
+        print('{}: {:.2f} it/s'.format(precision, speed[precision]))
+    print('bf16 speedup: {:.2f}x'.format(speed['bf16'] / speed['fp32']))
+
+    print('\n{:>12} {:>10} {:>10} {:>10} {:>10}'.format('iterations', 'errD fp32', 'errD bf16', 'errG fp32', 'errG bf16'))
+    for start in range(0, args.num_iter, args.window):
+        w = slice(start, start + args.window)
+        a, b = results['fp32'][w], results['bf16'][w]
+        print('{:>12} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}'.format('{}-{}'.format(start, start + len(a)),
+              a['errD'].mean(), b['errD'].mean(), a['errG'].mean(), b['errG'].mean()))
@@ -0,0 +1,75 @@
+import os
+import threading
+
+from queue import Queue
+
+import torch
+
+
+def to_cpu(obj):
+    '''copy of a state_dict (or any nesting of dicts, lists and tuples) with every tensor cloned to the CPU'''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomic(obj, filename):
+    '''torch.save to a temporary file renamed to filename, so that a crash never leaves a truncated checkpoint'''
+    torch.save(obj, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+class CheckpointWriter():
+    '''
+    Saves checkpoints on a background thread. save() takes a CPU snapshot of the
+    object right away, so training can go on changing the weights, and at most
+    max_pending snapshots wait to be written: save() blocks when there are more.
+    flush() waits until everything is on disk, close() also stops the thread, which
+    is started again by the next save. An error in the writer is raised by the next
+    save, flush or close.
+    '''
+    def __init__(self, max_pending=2):
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = None
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, filename = item
+            try:
+                save_atomic(obj, filename)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, filename):
+        self.check()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((to_cpu(obj), filename))
+
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check()
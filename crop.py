@@ -90,15 +90,28 @@ from skimage import img_as_float
 from skimage.transform import resize
 
 import os
+import multiprocessing
 import numpy as np
 
+import datasets
+
+# Crops every raw image once; rerunning only processes images that are new or
+# changed since their cropped copy was written.
+
+N_WORKERS = os.cpu_count()
+
 basedir = '/home/ubuntu/LIN_deletions/LIN_Normalized_all_size-128-512_train/'
 basedirt = '/home/ubuntu/LIN_deletions_cropped/'
 
-if not os.path.exists(basedirt):
+# write the cropped images straight into a packed dataset (see datasets.pack_images) instead of jpegs
+packdir = None
+# packdir = '/home/ubuntu/LIN_deletions_packed/'
+
+if packdir is None and not os.path.exists(basedirt):
 	os.makedirs(basedirt)
 
-pairs = os.listdir(basedir)
+manifest = datasets.Manifest(basedir)
+pairs = manifest.dirs
 pairs = sorted(pairs)
 
 proteins = []
@@ -132,11 +145,26 @@ deletions_counter = dict()
 
 cnt = np.zeros((41, 35))
 
+
+def crop(args):
+    src, dst = args
+
+    img = imread(src)
+    img = img_as_float(img)
+
+    img = img[16:-16,128:-128,:]
+    img = resize(img, (48, 128))
+
+    imsave(dst, img)
+
+
+jobs = []
+
 for pair in tqdm(pairs):
     path = basedir + pair + '/'
-    filenames = list(filter(lambda x: (x.endswith('.jpg') or x.endswith('.jpeg') or x.endswith('.png')), os.listdir(path)))
+    filenames = manifest.list_images(pair)
 
-    if not os.path.exists(basedirt + pair + '/'):
+    if packdir is None and not os.path.exists(basedirt + pair + '/'):
         os.makedirs(basedirt + pair + '/')
 
     gen = pair[2:].split('_D_')[0]
@@ -147,17 +175,21 @@ for pair in tqdm(pairs):
 
     cnt[prt2id[gen], del2id[deletion]] = len(filenames)
 
-    for filename in filenames:
-        # s = time()
-        img = imread(path + filename)
-        img = img_as_float(img)
-        # print(time()-s)
-        # s = time()
-
-        img = img[16:-16,128:-128,:]
-        img = resize(img, (48, 128))
-
-        imsave(basedirt + pair + '/' + filename, img)
+    for filename, mtime in zip(filenames, manifest.stat_mtimes(pair)):
+        dst = basedirt + pair + '/' + filename
+        if packdir is None and (not os.path.exists(dst) or os.stat(dst).st_mtime_ns < mtime):
+            jobs.append((path + filename, dst))
+
+if packdir is not None:
+    datasets.pack_images(basedir, packdir, raw=True, n_workers=N_WORKERS)
+else:
+    print('{} images to crop'.format(len(jobs)))
+
+    pool = multiprocessing.get_context('fork').Pool(N_WORKERS)
+    for _ in tqdm(pool.imap_unordered(crop, jobs, chunksize=64), total=len(jobs)):
+        pass
+    pool.close()
+    pool.join()
         
 
 # for a in sorted(list(gens_counter.keys())[:6]):
@@ -1,6 +1,8 @@
 import torch
 from torch.autograd import Variable
-from torch.utils.data import Dataset, DataLoader
+from torch.nn import functional as F
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
+from torch.utils.data.sampler import RandomSampler, SequentialSampler
 from torchvision import transforms, utils
 
 import numpy as np
@@ -10,6 +12,13 @@ import torchvision.datasets as dset
 import torchvision.transforms as transforms
 
 import os
+import multiprocessing
+import tempfile
+import threading
+from time import time
+
+from queue import Queue, Empty
+from itertools import islice, chain, count
 
 from skimage.io import imread
 from skimage import img_as_float
@@ -17,6 +26,660 @@ from skimage.transform import resize
 
 import pandas as pd
 
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_images(path):
+    return list(filter(lambda x: x.endswith(IMG_EXTENSIONS), os.listdir(path)))
+
+
+def read_image(filename, raw=False):
+    '''reads a LIN image as a float32 array of shape (2, H, W)'''
+    img = imread(filename)
+    img = img_as_float(img)
+
+    if raw:
+        img = img[16:-16,128:-128,:]
+        img = resize(img, (48, 128))
+
+    img = np.rollaxis(img[:,:,:2], 2, 0)
+    return np.asarray(img, dtype=np.float32)
+
+
+def _read_chunk(args):
+    filenames, raw = args
+    return np.stack([read_image(filename, raw=raw) for filename in filenames], axis=0)
+
+
+def read_images(filenames, raw=False, n_workers=None, chunksize=64, out=None, dtype=np.float32):
+    '''
+    Decodes filenames into one preallocated array of shape (N, 2, H, W), keeping their order.
+        Args:
+            n_workers: number of decoding processes, None for all cores, 1 decodes serially.
+            chunksize: number of images decoded by a worker per task.
+            out: preallocated array to fill (e.g. a memmap), uint8 arrays get values in 0..255.
+            dtype: dtype of the array allocated when out is None.
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    chunks = [(filenames[i:i+chunksize], raw) for i in range(0, len(filenames), chunksize)]
+
+    if out is None:
+        shape = read_image(filenames[0], raw=raw).shape if filenames else (2, 0, 0)
+        out = np.zeros((len(filenames),) + shape, dtype=dtype)
+
+    pool = None
+    if n_workers > 1 and len(chunks) > 1:
+        # fork explicitly: the training scripts run at import time
+        pool = multiprocessing.get_context('fork').Pool(min(n_workers, len(chunks)))
+        results = pool.imap(_read_chunk, chunks)
+    else:
+        results = map(_read_chunk, chunks)
+
+    from tqdm import tqdm
+
+    start = 0
+    for chunk in tqdm(results, total=len(chunks)):
+        if out.dtype == np.uint8:
+            chunk = np.round(np.clip(chunk, 0, 1) * 255)
+        out[start:start+len(chunk)] = chunk
+        start += len(chunk)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return out
+
+
+def read_shared_images(filenames, raw=False, n_workers=None, dtype=np.float32):
+    '''
+    read_images decoding straight into one tensor in shared memory. DataLoader workers,
+    forked or spawned, read it without copying, so memory stays flat with num_workers.
+    '''
+    shape = read_image(filenames[0], raw=raw).shape if filenames else (2, 0, 0)
+
+    images = torch.empty((len(filenames),) + shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype).share_memory_()
+    read_images(filenames, raw=raw, n_workers=n_workers, out=images.numpy())
+    return images
+
+
+def apply_transform(images, transform):
+    '''applies a per-image transform in place to a (N, C, H, W) tensor'''
+    if transform:
+        for i in range(len(images)):
+            images[i] = transform(images[i])
+    return images
+
+
+def normalize_batch(x, transform=None):
+    '''
+    Converts a uint8 batch (B, C, H, W) to float in [0, 1] and applies a
+    transforms.Normalize to the whole batch at once.
+    '''
+    x = x.float().div_(255)
+
+    if transform is not None:
+        c = x.size(1)
+        mean = torch.FloatTensor(list(transform.mean)[:c]).view(1, c, 1, 1).type_as(x)
+        std = torch.FloatTensor(list(transform.std)[:c]).view(1, c, 1, 1).type_as(x)
+        x = x.sub_(mean).div_(std)
+
+    return x
+
+
+def expand_channels(x, y, n_groups, n_shared=0):
+    '''
+    Builds multichannel batches from compact samples. x is (B, n_shared + K, H, W) and
+    y holds the group of every sample: the first n_shared channels are copied, the other
+    K channels go to group y[i] out of n_groups, all other groups stay zero.
+    Returns a (B, n_shared + n_groups * K, H, W) tensor.
+    '''
+    b, c, h, w = x.size()
+    k = c - n_shared
+    y = y.view(-1, 1).long()
+
+    out = x.new(b, n_shared + n_groups * k, h, w).zero_()
+    if n_shared:
+        out[:, :n_shared] = x[:, :n_shared]
+
+    channels = n_shared + y * k + torch.arange(k).type_as(y).view(1, -1)
+    rows = torch.arange(b).type_as(y).view(-1, 1).expand(b, k)
+    out[rows, channels] = x[:, n_shared:]
+
+    return out
+
+
+def to_cuda(batch, pin=False):
+    '''moves a tensor or a list of tensors to the GPU, through pinned memory if pin'''
+    if type(batch) == list or type(batch) == tuple:
+        return [to_cuda(x, pin) for x in batch]
+    if pin:
+        return batch.pin_memory().cuda(non_blocking=True)
+    return batch.cuda()
+
+
+def _replace_with(filename, write):
+    '''
+    write(f) to a temporary file of its own, then renamed to filename: a killed job never
+    leaves a truncated file behind, and jobs writing filename at the same time do not mix
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def _save_npy(filename, array):
+    _replace_with(filename, lambda f: np.save(f, array))
+
+
+def _scan_dir(path):
+    names, sizes, mtimes = [], [], []
+    for entry in os.scandir(path):
+        if entry.name.endswith(IMG_EXTENSIONS):
+            st = entry.stat()
+            names.append(entry.name)
+            sizes.append(st.st_size)
+            mtimes.append(st.st_mtime_ns)
+
+    order = np.argsort(names)
+    return np.array(names, dtype=str)[order], np.array(sizes, dtype=np.int64)[order], np.array(mtimes, dtype=np.int64)[order]
+
+
+class Manifest():
+    '''
+    Index of the images in basedir/<dir>/: for every directory its mtime and parsed
+    (gene, deletion) labels ('' for directories that are not M_<gene>_D_<deletion>
+    pairs), for every image its filename, size and mtime, relative to basedir.
+    It is kept in filename (<basedir>.manifest.npz by default). Opening it stats
+    basedir and the directories only; directories whose mtime changed are rescanned
+    and the file is rewritten, if it can be: on a read-only mount the index is only
+    kept in memory (pass a writable filename to keep it across runs). Overwriting an image in place does not change the mtime
+    of its directory, so the stored image mtimes only reflect files added or removed:
+    freshness checks use stat_mtimes.
+    '''
+    def __init__(self, basedir, filename=None):
+        self.basedir = basedir
+        self.filename = filename if filename is not None else basedir.rstrip('/') + '.manifest.npz'
+        self.root_mtime = None
+        self.entries = dict()  # dir -> (mtime, filenames, sizes, mtimes)
+
+        if os.path.exists(self.filename):
+            self.load()
+        self.update()
+
+    def load(self):
+        index = np.load(self.filename)
+        dirs, dir_mtimes, counts = index['dirs'], index['dir_mtimes'], index['counts']
+        filenames, sizes, mtimes = index['filenames'], index['sizes'], index['mtimes']
+
+        self.root_mtime = int(index['root_mtime'])
+
+        start = 0
+        for d, mtime, count in zip(dirs, dir_mtimes, counts):
+            self.entries[str(d)] = (int(mtime), filenames[start:start+count], sizes[start:start+count], mtimes[start:start+count])
+            start += count
+
+    def update(self):
+        root_mtime = os.stat(self.basedir).st_mtime_ns
+
+        # the set of directories can only change together with basedir's mtime
+        if root_mtime != self.root_mtime:
+            dirs = sorted(d for d in os.listdir(self.basedir) if os.path.isdir(os.path.join(self.basedir, d)))
+        else:
+            dirs = sorted(self.entries)
+
+        changed = root_mtime != self.root_mtime
+        entries = dict()
+        for d in dirs:
+            # stat before scanning: a change during the scan is picked up next time
+            mtime = os.stat(os.path.join(self.basedir, d)).st_mtime_ns
+            if d in self.entries and self.entries[d][0] == mtime:
+                entries[d] = self.entries[d]
+            else:
+                entries[d] = (mtime,) + _scan_dir(os.path.join(self.basedir, d))
+                changed = True
+
+        self.root_mtime = root_mtime
+        self.entries = entries
+
+        if changed:
+            self.save()
+
+    def save(self):
+        dirs = self.dirs
+        labels = [parse_pair(d) if '_D_' in d else ('', '') for d in dirs]
+
+        index = dict(root_mtime=self.root_mtime, dirs=np.array(dirs, dtype=str),
+                     dir_mtimes=np.array([self.entries[d][0] for d in dirs], dtype=np.int64),
+                     genes=np.array([g for g, _ in labels], dtype=str), deletions=np.array([d for _, d in labels], dtype=str),
+                     counts=np.array([len(self.entries[d][1]) for d in dirs], dtype=np.int64),
+                     filenames=np.concatenate([self.entries[d][1] for d in dirs] + [np.array([], dtype=str)]),
+                     sizes=np.concatenate([self.entries[d][2] for d in dirs] + [np.array([], dtype=np.int64)]),
+                     mtimes=np.concatenate([self.entries[d][3] for d in dirs] + [np.array([], dtype=np.int64)]))
+        try:
+            _replace_with(self.filename, lambda f: np.savez(f, **index))
+        except OSError as e:
+            print('manifest of {} not saved: {}'.format(self.basedir, e))
+
+    @property
+    def dirs(self):
+        return sorted(self.entries)
+
+    def list_images(self, d):
+        '''sorted image filenames of basedir/d/, like list_images(basedir + d)'''
+        return list(self.entries[d][1])
+
+    def mtimes(self, d):
+        '''mtimes (ns) of the images of d when d was last scanned, in the order of list_images(d)'''
+        return self.entries[d][3]
+
+    def stat_mtimes(self, d):
+        '''current mtimes (ns) of the images of d, in the order of list_images(d)'''
+        path = os.path.join(self.basedir, d)
+        return np.array([os.stat(os.path.join(path, f)).st_mtime_ns for f in self.entries[d][1]], dtype=np.int64)
+
+    def dir_mtime(self, d):
+        return self.entries[d][0]
+
+
+def update_shards(basedir, sharddir, raw=False, n_workers=None, batch_images=20000, manifest=None):
+    '''
+    Decodes basedir/<class>/ into one uint8 shard per class directory: sharddir/<class>.npy
+    holds the images and sharddir/<class>.names.npy their filenames. A shard that is
+    newer than its directory and all of its images is kept, so adding a strain
+    directory only decodes that directory. Stale directories are decoded in parallel
+    batches of about batch_images images. Returns the names of the rebuilt shards.
+    manifest: file of the Manifest of basedir, <basedir>.manifest.npz if None
+    '''
+    if not os.path.exists(sharddir):
+        os.makedirs(sharddir)
+
+    manifest = Manifest(basedir, manifest)
+    dirs = manifest.dirs
+
+    stale = []
+    for d in dirs:
+        names = manifest.list_images(d)
+        mtime = max([manifest.dir_mtime(d)] + list(manifest.stat_mtimes(d)))
+
+        shard = os.path.join(sharddir, d + '.npy')
+        if not os.path.exists(shard) or os.stat(shard).st_mtime_ns < mtime:
+            stale.append((d, names))
+
+    # shards of directories that disappeared
+    for f in os.listdir(sharddir):
+        if f.endswith('.names.npy') and f[:-len('.names.npy')] not in dirs:
+            # the images are removed first, a shard without them is incomplete
+            images = os.path.join(sharddir, f[:-len('.names.npy')] + '.npy')
+            if os.path.exists(images):
+                os.remove(images)
+            os.remove(os.path.join(sharddir, f))
+
+    i = 0
+    while i < len(stale):
+        batch = [stale[i]]
+        i += 1
+        while i < len(stale) and sum(len(names) for _, names in batch) + len(stale[i][1]) <= batch_images:
+            batch.append(stale[i])
+            i += 1
+
+        paths = [os.path.join(basedir, d, f) for d, names in batch for f in names]
+        images = read_images(paths, raw=raw, n_workers=n_workers, dtype=np.uint8)
+
+        start = 0
+        for d, names in batch:
+            # the images mark the shard as complete (see list_shards): old ones are removed
+            # before the names change and the new ones are saved last
+            shard = os.path.join(sharddir, d + '.npy')
+            if os.path.exists(shard):
+                os.remove(shard)
+            _save_npy(os.path.join(sharddir, d + '.names.npy'), np.array(names))
+            _save_npy(shard, images[start:start+len(names)])
+            start += len(names)
+
+    return [d for d, _ in stale]
+
+
+def list_shards(sharddir):
+    '''names of the complete shards of sharddir: those whose images were written'''
+    return sorted(f[:-len('.names.npy')] for f in os.listdir(sharddir)
+                  if f.endswith('.names.npy') and os.path.exists(os.path.join(sharddir, f[:-len('.names.npy')] + '.npy')))
+
+
+def pack_shards(sharddir, packdir):
+    '''
+    Concatenates the shards written by update_shards into one contiguous uint8
+    array (packdir/images.npy) plus a label index (packdir/index.npz). Nothing is
+    rewritten if the pack was built from the same shards.
+    '''
+    if not os.path.exists(packdir):
+        os.makedirs(packdir)
+
+    dirs = list_shards(sharddir)
+    index_file = os.path.join(packdir, 'index.npz')
+
+    shard_mtimes = np.array([os.stat(os.path.join(sharddir, d + '.npy')).st_mtime_ns for d in dirs], dtype=np.int64)
+    if os.path.exists(index_file):
+        index = np.load(index_file)
+        if 'shard_mtimes' in index and list(index['dirs']) == dirs and np.array_equal(index['shard_mtimes'], shard_mtimes):
+            return
+
+    shards = [np.load(os.path.join(sharddir, d + '.npy'), mmap_mode='r') for d in dirs]
+    filenames = [np.load(os.path.join(sharddir, d + '.names.npy')) for d in dirs]
+
+    shape = next(shard.shape[1:] for shard in shards if len(shard))
+    n_images = sum(len(shard) for shard in shards)
+
+    # readers keep the old files open until they reopen the pack
+    images = np.lib.format.open_memmap(os.path.join(packdir, 'images.npy.tmp'), mode='w+', dtype=np.uint8, shape=(n_images,) + shape)
+
+    start = 0
+    for shard in shards:
+        images[start:start+len(shard)] = shard
+        start += len(shard)
+
+    images.flush()
+    del images
+
+    dir_ids = np.repeat(np.arange(len(dirs), dtype=np.int32), [len(shard) for shard in shards])
+
+    os.replace(os.path.join(packdir, 'images.npy.tmp'), os.path.join(packdir, 'images.npy'))
+    with open(index_file + '.tmp', 'wb') as f:
+        np.savez(f, dirs=np.array(dirs), dir_ids=dir_ids, filenames=np.concatenate(filenames), shard_mtimes=shard_mtimes)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def pack_images(basedir, packdir, raw=False, n_workers=None):
+    '''
+    Decodes every image in basedir/<class>/ once and writes all of them to packdir
+    as one contiguous uint8 array (images.npy) plus a label index (index.npz).
+    Decoded directories are kept as shards in packdir/shards/, so rerunning it
+    after new directories arrive only decodes those. The index is written last,
+    so a pack without it is incomplete.
+    '''
+    update_shards(basedir, os.path.join(packdir, 'shards'), raw=raw, n_workers=n_workers)
+    pack_shards(os.path.join(packdir, 'shards'), packdir)
+
+
+def load_pack(packdir):
+    '''
+    Opens a pack written by pack_images. Images are memory-mapped copy-on-write,
+    so the page cache is shared between all processes reading the same pack.
+    '''
+    index = np.load(os.path.join(packdir, 'index.npz'))
+    images = np.load(os.path.join(packdir, 'images.npy'), mmap_mode='c')
+    return images, list(index['dirs']), index['dir_ids']
+
+
+def parse_pair(pair):
+    '''M_<gene>_D_<deletion> -> (gene, deletion)'''
+    gen, deletion = pair[2:].split('_D_')
+    return gen, deletion
+
+
+def packed_to_float(img, transform=None):
+    img = torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.)
+    if transform:
+        img = transform(img)
+    return img
+
+
+class ByteImages():
+    '''
+    Finishes batches of datasets that store images as uint8 (storage='uint8'):
+    float conversion and normalization happen once per batch in MyDataLoader.
+    '''
+    def check_storage(self, storage, transform):
+        assert storage in ['float', 'uint8']
+        if storage == 'uint8':
+            assert transform is None or isinstance(transform, transforms.Normalize), 'only transforms.Normalize can be applied per batch'
+        self.storage = storage
+
+    def get_images(self, indices):
+        '''gathers a batch of images with one indexing op'''
+        if self.index is None:
+            return self.images[torch.from_numpy(indices)]
+
+        images = torch.from_numpy(self.images[self.index[indices]])
+
+        if self.storage == 'uint8':
+            return images
+        if self.transform is None or isinstance(self.transform, transforms.Normalize):
+            return normalize_batch(images, self.transform)
+        return torch.stack([self.get_image(i) for i in indices], dim=0)
+
+    def finish_batch(self, batch):
+        if self.storage != 'uint8':
+            return batch
+
+        if type(batch) == list or type(batch) == tuple:
+            return [normalize_batch(batch[0], self.transform)] + list(batch[1:])
+        return normalize_batch(batch, self.transform)
+
+
+def seed_worker(worker_id):
+    '''
+    worker_init_fn for DataLoaders over datasets sampling with numpy: forked workers
+    start with the same numpy state and would return the same samples, so seed
+    numpy from the per-worker torch seed. MyDataLoader sets it on DataLoaders that
+    have workers and no worker_init_fn (see seed_loader).
+    '''
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+class RandomBatchSampler():
+    '''Yields batches of indices as slices of one permutation per epoch'''
+    def __init__(self, n, batch_size, shuffle=True, drop_last=False):
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = np.random
+        self.rank, self.world_size = 0, 1
+
+    def set_epoch(self, epoch, seed=None):
+        '''the permutation of the next epoch depends only on seed and epoch (np.random if seed is None)'''
+        self.rng = np.random.RandomState([seed, epoch]) if seed is not None else np.random
+
+    def shard(self, rank, world_size):
+        '''
+        Every rank takes a disjoint slice of the same permutation (seed it with set_epoch),
+        padded with its first indices so that all ranks get ceil(n / world_size) of them.
+        '''
+        self.rank, self.world_size = rank, world_size
+
+    def shard_size(self):
+        return (self.n + self.world_size - 1) // self.world_size
+
+    def __iter__(self):
+        order = self.rng.permutation(self.n) if self.shuffle else np.arange(self.n)
+
+        if self.world_size > 1:
+            order = np.resize(order, self.shard_size() * self.world_size)[self.rank::self.world_size]
+
+        for i in range(len(self)):
+            yield order[i*self.batch_size:(i+1)*self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.shard_size() // self.batch_size
+        return (self.shard_size() + self.batch_size - 1) // self.batch_size
+
+
+def alias_table(weights):
+    '''Vose's alias tables (prob, alias) for drawing i with probability proportional to weights[i]'''
+    p = np.asarray(weights, dtype=np.float64)
+    p = p * len(p) / p.sum()
+
+    prob = np.ones(len(p))
+    alias = np.arange(len(p))
+
+    small = [i for i in range(len(p)) if p[i] < 1]
+    large = [i for i in range(len(p)) if p[i] >= 1]
+
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = p[s]
+        alias[s] = l
+        p[l] -= 1 - p[s]
+        (small if p[l] < 1 else large).append(l)
+
+    return prob, alias
+
+
+def alias_draw(prob, alias, n, rng=np.random):
+    '''n draws from alias tables, O(1) each'''
+    i = rng.randint(len(prob), size=n)
+    return np.where(rng.random_sample(n) < prob[i], i, alias[i])
+
+
+class BalancedBatchSampler():
+    '''
+    Batch sampler over LINwithdeletions drawing images with replacement so that
+        'pairs': every (gene, deletion) pair present is equally likely,
+        'genes': every gene is equally likely, its pairs too,
+        'deletions': every deletion is equally likely, its pairs too,
+        'images': every image is equally likely (what shuffle=True does).
+    A pair is drawn from alias tables, then an image uniformly within the pair.
+    n_batches is the length of an epoch, len(gens) // batch_size by default.
+    '''
+    def __init__(self, gens, deletions, batch_size, weighting='pairs', n_batches=None):
+        assert weighting in ['pairs', 'genes', 'deletions', 'images']
+
+        gens = np.asarray(gens)
+        deletions = np.asarray(deletions)
+
+        keys = gens * (deletions.max() + 2) + deletions + 1
+        _, first, pairs = np.unique(keys, return_index=True, return_inverse=True)
+
+        # images sorted by pair, the images of pair k are order[starts[k]:starts[k]+counts[k]]
+        self.order = np.argsort(pairs, kind='stable')
+        self.counts = np.bincount(pairs)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+        if weighting == 'pairs':
+            weights = np.ones(len(self.counts))
+        elif weighting == 'genes':
+            weights = 1. / np.bincount(gens[first])[gens[first]]
+        elif weighting == 'deletions':
+            weights = 1. / np.bincount(deletions[first] + 1)[deletions[first] + 1]
+        else:
+            weights = self.counts
+
+        self.prob, self.alias = alias_table(weights)
+
+        self.batch_size = batch_size
+        self.n_batches = n_batches if n_batches is not None else len(gens) // batch_size
+        self.rng = np.random
+        self.rank, self.world_size = 0, 1
+
+    def set_epoch(self, epoch, seed=None):
+        '''the draws of the next epoch depend only on seed, epoch and rank (np.random if seed is None)'''
+        if seed is None:
+            self.rng = np.random
+        elif self.world_size > 1:
+            self.rng = np.random.RandomState([seed, epoch, self.rank])
+        else:
+            self.rng = np.random.RandomState([seed, epoch])
+
+    def shard(self, rank, world_size):
+        '''every rank draws its own ceil(n_batches / world_size) batches per epoch, with the same weighting'''
+        self.rank, self.world_size = rank, world_size
+
+    def sample(self, n, rng=np.random):
+        pairs = alias_draw(self.prob, self.alias, n, rng)
+        return self.order[self.starts[pairs] + (rng.random_sample(n) * self.counts[pairs]).astype(np.int64)]
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield self.sample(self.batch_size, self.rng)
+
+    def __len__(self):
+        return (self.n_batches + self.world_size - 1) // self.world_size
+
+
+class ClassIndex():
+    '''
+    Dataset positions sorted by label, so that the positions of every class are one
+    contiguous range: positions(c) is a view and sample(c, k) costs O(k), not O(size of c).
+    '''
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+
+        self.order = np.argsort(labels, kind='stable')
+        self.counts = np.bincount(labels)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def positions(self, c):
+        return self.order[self.starts[c]:self.starts[c] + self.counts[c]]
+
+    def sample(self, c, k, rng=np.random):
+        '''k random positions of class c, without replacement if it has at least k'''
+        n = self.counts[c]
+        assert n > 0, 'no samples of class {}'.format(c)
+        if k > n:
+            i = rng.randint(n, size=k)
+        elif 2 * k > n:
+            i = rng.permutation(n)[:k]
+        else:
+            # Floyd's algorithm: k distinct values of range(n) with k draws
+            chosen = set()
+            for j in range(n - k, n):
+                t = rng.randint(j + 1)
+                chosen.add(j if t in chosen else t)
+            i = rng.permutation(np.fromiter(chosen, dtype=np.int64, count=k))
+        return self.order[self.starts[c] + i]
+
+
+class BatchLoader():
+    '''
+    Replaces a DataLoader for datasets with get_batch(indices): every batch is
+    gathered from the dataset's backing arrays at once instead of collating items.
+    '''
+    def __init__(self, dataset, batch_sampler):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def set_epoch(self, epoch, seed=None, start=0):
+        '''seeds the batch sampler for epoch and skips the first start batches of its next pass'''
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch, seed)
+        self.start = start
+
+    def __iter__(self):
+        for i, indices in enumerate(self.batch_sampler):
+            # skipped batches only cost drawing their indices
+            if i >= self.start:
+                yield self.dataset.get_batch(np.asarray(indices))
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    @staticmethod
+    def from_loader(dataloader):
+        '''BatchLoader doing what dataloader does, or dataloader itself if its dataset has no get_batch'''
+        dataset = getattr(dataloader, 'dataset', None)
+        if not hasattr(dataset, 'get_batch') or dataloader.batch_sampler is None:
+            return dataloader
+
+        batch_sampler = dataloader.batch_sampler
+        if type(batch_sampler) == torch.utils.data.sampler.BatchSampler and type(batch_sampler.sampler) in [RandomSampler, SequentialSampler]:
+            batch_sampler = RandomBatchSampler(len(dataset), batch_sampler.batch_size,
+                                               shuffle=type(batch_sampler.sampler) == RandomSampler, drop_last=batch_sampler.drop_last)
+
+        return BatchLoader(dataset, batch_sampler)
+
+
 class GaussianMixtureDataset(Dataset):
     """Points from multiple gaussians"""
 
@@ -31,12 +694,12 @@ class GaussianMixtureDataset(Dataset):
         assert len(mean_list) == len(component_size_list)
         self.mean_list = mean_list
         self.component_size_list = component_size_list
-        d = len(mean_list[0])
-        self.data = np.zeros((0, d))
+        self.means = np.asarray(mean_list, dtype=np.float64)
+        d = self.means.shape[1]
         self.n_components = len(mean_list)
 
-        for i in range(self.n_components):
-            self.data = np.concatenate([self.data, multivariate_normal(mean=mean_list[i], cov=np.eye(d), size=component_size_list[i])], axis=0)
+        # unit covariance: every point is its component mean plus standard normal noise
+        self.data = np.repeat(self.means, component_size_list, axis=0) + normal(size=(sum(component_size_list), d))
 
         self.data = np.asarray(self.data, dtype=np.float32)           
 
@@ -44,9 +707,25 @@ class GaussianMixtureDataset(Dataset):
         return self.data.shape[0]
 
     def __getitem__(self, idx):
-        # return self.data[idx,:]
-        # print(type(self.mean_list))
-        return self.mean_list[randint(0, len(self.mean_list))] + normal(size=len(self.mean_list[0]))
+        # a fresh point from np.random, seeded per DataLoader worker by seed_worker
+        return self.sample(1)[0]
+
+    def sample(self, n, rng=np.random):
+        '''draws n fresh points from the mixture at once'''
+        return self.means[rng.randint(0, self.n_components, size=n)] + rng.normal(size=(n, self.means.shape[1]))
+
+    def get_batch(self, indices):
+        return torch.from_numpy(self.sample(len(indices)))
+
+    def batch_iterator(self, batch_size, is_cuda=False, seed=None):
+        '''infinite iterator of fresh batches, can be passed to GAN_base.train instead of a MyDataLoader iterator'''
+        rng = np.random if seed is None else np.random.RandomState(seed)
+
+        while True:
+            batch = torch.from_numpy(self.sample(batch_size, rng)).float()
+            if is_cuda:
+                batch = batch.cuda()
+            yield Variable(batch)
 
 
 class ConditionalGaussianMixtureDataset(Dataset):
@@ -65,82 +744,368 @@ class ConditionalGaussianMixtureDataset(Dataset):
         self.component_class_list = component_class_list
         self.n_classes = n_classes
         self.d = len(mean_list[0])
-        self.data = np.zeros((0, self.d + self.n_classes))
 
         self.n_components = len(mean_list)
 
-        for i in range(self.n_components):
-            onehot = np.zeros((component_size_list[i], self.n_classes))
-            onehot[:,component_class_list[i]] = 1
-            batch = np.concatenate([multivariate_normal(mean=mean_list[i], cov=np.eye(self.d), size=component_size_list[i]), onehot], axis=1)
-            self.data = np.concatenate([self.data, batch], axis=0)
-
-        self.data = np.asarray(self.data, dtype=np.float32)           
+        # points and their int64 labels are kept apart, MyDataLoader yields (points, labels) as is
+        means = np.asarray(mean_list, dtype=np.float64)
+        self.points = np.repeat(means, component_size_list, axis=0) + normal(size=(sum(component_size_list), self.d))
+        self.points = np.asarray(self.points, dtype=np.float32)
+        self.labels = np.repeat(np.asarray(component_class_list, dtype=np.int64), component_size_list)
 
     def __len__(self):
-        return self.data.shape[0]
+        return self.points.shape[0]
 
     def __getitem__(self, idx):
-        return self.data[idx,:]
+        return self.points[idx,:], self.labels[idx]
 
+    def get_batch(self, indices):
+        return [torch.from_numpy(self.points[indices]), torch.from_numpy(self.labels[indices])]
 
-class MNISTDataset(Dataset):
-    """Points from multiple gaussians"""
 
-    def __init__(self, selected=None, train=True):
-        self.data = dset.MNIST(root = './data/',
-                         transform=transforms.Compose([
-                               transforms.Scale(32),
-                               transforms.ToTensor(),
-                               transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                           ]),
-                          download = True, train=train)
+_tensorized = {}
+
+
+def load_tensorized(name, root, train=True, size=32):
+    '''
+    Returns the images of a torchvision 'mnist' or 'cifar10' split as one float
+    (N, C, size, size) tensor normalized to [-1, 1], and its labels as a LongTensor.
+    The split is resized once with batched bilinear interpolation and cached as .npy
+    files in root; later calls in the same process reuse the tensors.
+    '''
+    split = 'train' if train else 'test'
+    key = (name, root, split, size)
+    if key in _tensorized:
+        return _tensorized[key]
+
+    prefix = os.path.join(root, '{}_{}_{}'.format(name, split, size))
+
+    if os.path.exists(prefix + '_images.npy') and os.path.exists(prefix + '_labels.npy'):
+        images = np.load(prefix + '_images.npy')
+        labels = np.load(prefix + '_labels.npy')
+    else:
+        data = {'mnist': dset.MNIST, 'cifar10': dset.CIFAR10}[name](root=root, download=True, train=train)
+
+        x = torch.as_tensor(np.asarray(data.data))
+        labels = np.asarray(data.targets, dtype=np.int64)
+
+        # MNIST is (N, H, W), CIFAR10 is (N, H, W, C)
+        x = x.unsqueeze(1) if x.dim() == 3 else x.permute(0, 3, 1, 2)
+        x = x.float().div_(255)
+        if x.size(2) != size or x.size(3) != size:
+            x = F.interpolate(x, size=(size, size), mode='bilinear', align_corners=False)
+        images = x.mul_(2).sub_(1).contiguous().numpy()
+
+        _save_npy(prefix + '_images.npy', images)
+        _save_npy(prefix + '_labels.npy', labels)
+
+    # shared by all datasets over the split and read by DataLoader workers without copying
+    _tensorized[key] = torch.from_numpy(images).share_memory_(), torch.from_numpy(labels).share_memory_()
+    return _tensorized[key]
+
+
+class TensorImages():
+    '''
+    Images of a split loaded by load_tensorized, restricted to class selected.
+    self.index maps dataset positions to rows of the shared tensors.
+    '''
+    def select(self, images, labels, selected=None):
+        self.images = images
+        self.labels = labels
 
         if selected is not None:
-            if train:
-                labels = self.data.train_labels.numpy()
-            else:
-                labels = self.data.test_labels.numpy()
-            self.index = np.arange(len(self.data))[np.where(labels == selected)[0]]
-            # self.data = torch.masked_select(self.data.train_data, (self.data.train_labels == selected).view(-1, 1, 1)).view(-1, 1, 32, 32)
+            self.index = np.where(labels.numpy() == selected)[0]
         else:
-            self.index = np.arange(len(self.data))
+            self.index = np.arange(len(images))
 
     def __len__(self):
         return len(self.index)
 
+
+class MNISTDataset(TensorImages, Dataset):
+    """Points from multiple gaussians"""
+
+    def __init__(self, selected=None, train=True):
+        self.select(*load_tensorized('mnist', './data/', train), selected=selected)
+
     def __getitem__(self, idx):
-        return self.data[self.index[idx]][0]
+        return self.images[self.index[idx]]
+
+    def get_batch(self, indices):
+        return self.images[torch.from_numpy(self.index[indices])]
         
-class labeledMNISTDataset(Dataset):
+class labeledMNISTDataset(TensorImages, Dataset):
     """Points from multiple gaussians"""
 
     def __init__(self):
-        self.data = dset.MNIST(root = './data/',
-                         transform=transforms.Compose([
-                               transforms.Scale(32),
-                               transforms.ToTensor(),
-                               transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                           ]),
-                          download = True)
-
-    def __len__(self):
-        return len(self.data)
+        self.select(*load_tensorized('mnist', './data/'))
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        return self.images[idx], self.labels[idx]
+
+    def get_batch(self, indices):
+        idx = torch.from_numpy(indices)
+        return [self.images[idx], self.labels[idx]]
+
+class BatchAugment():
+    '''
+    Random augmentation of whole (B, C, H, W) image batches with parameters drawn per
+    sample: horizontal flips, vertical flips and 180 degree rotations with probabilities
+    hflip, vflip and rot180, shifts of up to translate pixels (borders are replicated)
+    and intensity jitter x * (1 + a) + b with a, b uniform in [-jitter, jitter] per
+    channel. Flips, rotation and shift are done by one gather. Values are clamped to
+    value_range if given. Parameters come from rng, so a seeded rng repeats them.
+    '''
+    def __init__(self, hflip=0.5, vflip=0.5, rot180=0.5, translate=0, jitter=0., value_range=None):
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rot180 = rot180
+        self.translate = translate
+        self.jitter = jitter
+        self.value_range = value_range
+
+    def __call__(self, batch, rng=np.random):
+        '''augments a batch, or the images of a [images, labels...] batch'''
+        if type(batch) == list or type(batch) == tuple:
+            return [self(batch[0], rng)] + list(batch[1:])
+
+        x = batch
+        b, c, h, w = x.size()
+
+        # a 180 degree rotation is a horizontal and a vertical flip
+        rot = rng.random_sample(b) < self.rot180
+        flip_h = (rng.random_sample(b) < self.hflip) ^ rot
+        flip_v = (rng.random_sample(b) < self.vflip) ^ rot
+
+        dy = rng.randint(-self.translate, self.translate + 1, size=(b, 1))
+        dx = rng.randint(-self.translate, self.translate + 1, size=(b, 1))
+
+        rows = np.clip(np.arange(h)[None, :] - dy, 0, h - 1)
+        cols = np.clip(np.arange(w)[None, :] - dx, 0, w - 1)
+        rows = np.where(flip_v[:, None], h - 1 - rows, rows)
+        cols = np.where(flip_h[:, None], w - 1 - cols, cols)
+
+        pixels = torch.from_numpy(rows[:, :, None] * w + cols[:, None, :]).to(x.device)
+        x = x.contiguous().view(b, c, h * w).gather(2, pixels.view(b, 1, h * w).expand(b, c, h * w)).view(b, c, h, w)
+
+        if self.jitter > 0:
+            scale = torch.from_numpy(1 + rng.uniform(-self.jitter, self.jitter, size=(b, c, 1, 1))).to(x)
+            shift = torch.from_numpy(rng.uniform(-self.jitter, self.jitter, size=(b, c, 1, 1))).to(x)
+            x = x.mul_(scale).add_(shift)
+
+        if self.value_range is not None:
+            x = x.clamp_(*self.value_range)
+
+        return x
+
+
+class _Raised():
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def seed_loader(dataloader, seed, epoch):
+    '''
+    Makes the shuffling and the worker seeds of the next pass of a torch DataLoader
+    depend only on seed and epoch (for versions whose DataLoader and RandomSampler
+    take a generator). Workers also get distinct numpy seeds (seed_worker).
+    '''
+    generator = torch.Generator()
+    generator.manual_seed(int(np.random.RandomState([seed, epoch]).randint(2**31)))
+
+    if hasattr(dataloader, 'generator'):
+        dataloader.generator = generator
+    if hasattr(getattr(dataloader, 'sampler', None), 'generator'):
+        dataloader.sampler.generator = generator
+
+    if getattr(dataloader, 'num_workers', 0) > 0 and dataloader.worker_init_fn is None:
+        dataloader.worker_init_fn = seed_worker
+
+
+class LoaderIterator():
+    '''
+    iterator returned by MyDataLoader.return_iterator, counts the time spent waiting
+    for batches and records the position of the last batch returned
+    '''
+    def __init__(self, loader, make_batches):
+        self.loader = loader
+        self.make_batches = make_batches
+        self.batches = make_batches()
+
+    def __iter__(self):
+        return self
+
+    def state_dict(self):
+        return self.loader.state_dict()
+
+    def load_state_dict(self, state):
+        '''restarts the stream at state, see MyDataLoader.load_state_dict'''
+        self.batches.close()
+        self.loader.load_state_dict(state)
+        self.batches = self.make_batches()
+
+    def __next__(self):
+        t = time()
+        i_epoch, i_batch, batch = next(self.batches)
+        self.loader.wait_time += time() - t
+        self.loader.i_epoch, self.loader.i_batch = i_epoch, i_batch
+        return batch
+
+    next = __next__
+
 
 class MyDataLoader():
     '''multiple epochs added'''
-    def __init__(self):
+    def __init__(self, seed=None, rank=None, world_size=None):
+        '''
+        seed: seed of the sample order of every epoch, drawn from np.random by each
+            return_iterator if None. See state_dict for resuming a run.
+        rank, world_size: with world_size > 1 every rank iterates over its own disjoint,
+            equally sized part of the data, reshuffled every epoch (see the shard methods
+            of the batch samplers and LINStream). Taken from torch.distributed if it is
+            initialized. All ranks need the same seed.
+        '''
+        if world_size is None and torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+        self.rank = rank if rank is not None else 0
+        self.world_size = world_size if world_size is not None else 1
+        assert self.world_size == 1 or seed is not None, 'ranks have to share the seed of the sample order'
+        assert 0 <= self.rank < self.world_size
+
         self.i_epoch = 0
+        self.i_batch = 0
         self.last_images = None
+        self.wait_time = 0.
+        self.init_seed = seed
+        self.seed = seed
+        self.resume_from = None
+
+    def state_dict(self):
+        '''
+        Position of the sample stream after the last batch the iterator returned: the
+        seed and the batch within the epoch. The order of an epoch, and the seeds of
+        DataLoader workers, depend only on seed and epoch, so this is the whole state.
+        '''
+        return {'seed': self.seed, 'i_epoch': self.i_epoch, 'i_batch': self.i_batch}
+
+    def load_state_dict(self, state):
+        '''
+        The next return_iterator continues the sample stream saved by state_dict: the
+        batches already returned are skipped without loading them (except for plain
+        DataLoaders over datasets without get_batch, which have to load them).
+        '''
+        self.seed = state['seed']
+        self.resume_from = (state['i_epoch'], state['i_batch'])
+
+    def return_iterator(self, dataloader, is_cuda=False, num_passes=None, conditional=False, pictures=False, n_classes=None, prefetch=0, augment=None):
+        '''
+        prefetch: number of batches prepared ahead on a background thread (moved to the GPU
+            through pinned memory, converted and split into labels); 0 prepares every
+            batch when it is requested.
+        augment: BatchAugment applied to every image batch on its device, with parameters
+            depending only on the seed and the position of the batch.
+        self.wait_time accumulates the seconds the caller spent waiting for batches.
+        '''
+        if self.resume_from is None:
+            self.seed = self.init_seed if self.init_seed is not None else np.random.randint(2**31)
+        self.wait_time = 0.
+
+        def make_batches():
+            start = self.resume_from if self.resume_from is not None else (0, 0)
+            self.resume_from = None
+            self.i_epoch, self.i_batch = start
+
+            batches = self.prepare_batches(dataloader, is_cuda, num_passes, conditional, pictures, n_classes, pin=is_cuda and prefetch > 0, augment=augment, start=start)
+
+            if prefetch > 0:
+                batches = self.prefetch(batches, prefetch)
+            return batches
+
+        return LoaderIterator(self, make_batches)
+
+    def prefetch(self, batches, n_batches):
+        queue = Queue(maxsize=n_batches)
+
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in batches:
+                    queue.put(batch)
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                queue.put(_Raised(e))
+            queue.put(None)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, _Raised):
+                    raise batch.exception
+                yield batch
+        finally:
+            # closed early (LoaderIterator.load_state_dict): the producer stops before touching the samplers again
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def shard(self, dataloader):
+        '''restricts dataloader to the part of the data of this rank'''
+        if isinstance(dataloader, BatchLoader) and hasattr(dataloader.batch_sampler, 'shard'):
+            dataloader.batch_sampler.shard(self.rank, self.world_size)
+        elif hasattr(getattr(dataloader, 'dataset', None), 'shard'):
+            dataloader.dataset.shard(self.rank, self.world_size)
+        else:
+            raise ValueError('cannot shard {}: use a dataset with get_batch or shard'.format(type(dataloader).__name__))
 
-    def return_iterator(self, dataloader, is_cuda=False, num_passes=None, conditional=False, pictures=False, n_classes=None):
-        self.i_epoch = 0
+    def prepare_batches(self, dataloader, is_cuda, num_passes, conditional, pictures, n_classes, pin=False, augment=None, start=(0, 0)):
+        dataloader = BatchLoader.from_loader(dataloader)
+
+        if self.world_size > 1:
+            self.shard(dataloader)
+
+        # datasets storing uint8 images convert and normalize them here, once per batch
+        finish_batch = getattr(getattr(dataloader, 'dataset', None), 'finish_batch', None)
         
-        while num_passes is None or self.i_epoch < num_passes:
-            for batch in dataloader:
+        # streaming datasets reshuffle with a seed per epoch
+        set_epoch = getattr(getattr(dataloader, 'dataset', None), 'set_epoch', None)
+        
+        i_epoch, start = start
+
+        while num_passes is None or i_epoch < num_passes:
+            if set_epoch is not None:
+                set_epoch(i_epoch)
+
+            if isinstance(dataloader, BatchLoader):
+                dataloader.set_epoch(i_epoch, self.seed, start)
+                batches = iter(dataloader)
+            else:
+                seed_loader(dataloader, self.seed, i_epoch)
+                batches = iter(dataloader)
+                for _ in range(start):
+                    next(batches, None)
+
+            for i_batch, batch in enumerate(batches, start + 1):
+                if is_cuda:
+                    batch = to_cuda(batch, pin)
+
+                if finish_batch is not None:
+                    batch = finish_batch(batch)
+
+                if augment is not None:
+                    batch = augment(batch, np.random.RandomState([self.seed, i_epoch, i_batch]))
+
                 if not conditional:
                     if is_cuda:
                         if type(batch) == list:
@@ -171,7 +1136,17 @@ class MyDataLoader():
                         
                         batch = data, labels
                         
+                    elif type(batch) == list or type(batch) == tuple:
+                        data, label = batch
+
+                        if is_cuda:
+                            data = data.cuda()
+                            label = label.cuda()
+
+                        batch = Variable(data).float(), Variable(label)
+
                     else:
+                        # points with a one-hot block appended
                         if is_cuda:
                             batch = batch.cuda()
                     
@@ -182,97 +1157,131 @@ class MyDataLoader():
                         _, label = torch.max(onehot, dim=1)
                         batch = data, label
                 
-                yield batch
-            self.i_epoch += 1
+                yield i_epoch, i_batch, batch
+            i_epoch += 1
+            start = 0
 
 
 
-class LINDataset(Dataset):
+class LINDataset(ByteImages, Dataset):
     """Points from multiple gaussians"""
 
-    def __init__(self, proteins=['Arp3'], basedir='/home/ubuntu/LIN/LIN_Normalized_WT_size-48-80_train/', transform=None, conditional=False, highres=False):
+    def __init__(self, proteins=['Arp3'], basedir='/home/ubuntu/LIN/LIN_Normalized_WT_size-48-80_train/', transform=None, conditional=False, highres=False, packed=None, n_workers=None, storage='float', manifest=None):
+        '''
+        packed: directory written by pack_images(basedir, packed), used instead of decoding basedir
+        n_workers: number of processes decoding the images, see read_images
+        storage: 'float' keeps normalized float32 images, 'uint8' keeps one uint8 (N, C, H, W)
+            tensor and leaves conversion and normalization to MyDataLoader
+        manifest: file of the Manifest of basedir, <basedir>.manifest.npz if None (e.g. a
+            writable path when basedir is on a read-only mount)
+        '''
+        self.check_storage(storage, transform)
 
         if highres:
             basedir='/home/ubuntu/LIN128/LIN_Normalized_WT_size-96-160_train/'
 
+        if packed is not None:
+            x, dirs, dir_ids = load_pack(packed)
+
+        if packed is None:
+            manifest = Manifest(basedir, manifest)
+
         if proteins == 'all':
-            proteins = os.listdir(basedir)
+            proteins = dirs if packed is not None else manifest.dirs
 
         self.proteins = proteins
         self.images = []
         self.conditional = conditional
         self.prt2id = dict(zip(proteins, range(len(proteins))))
+        self.transform = transform
 
         self.images = []
         self.labels = []
+        self.index = None
+
+        if packed is not None:
+            dir2label = np.array([self.prt2id.get(d, -1) for d in dirs], dtype=np.int64)
+            labels = dir2label[dir_ids]
+
+            self.index = np.where(labels >= 0)[0]
+            self.images = x
+            self.labels = labels[self.index]
+            return
+
+        filenames = []
 
         for protein in proteins:
             self.path = basedir + protein + '/'
-            filenames = list(filter(lambda x: (x.endswith('.jpg') or x.endswith('.jpeg') or x.endswith('.png')), os.listdir(self.path)))
-            self.transform = transform
+            names = manifest.list_images(protein)
 
-            for filename in filenames:
-                img = imread(self.path + filename)
-                img = img_as_float(img)
-                img = np.rollaxis(img[:,:,:2], 2, 0)
-                img = np.asarray(img, dtype=np.float32)
-                img = torch.from_numpy(img)
+            filenames += [self.path + filename for filename in names]
+            self.labels += [self.prt2id[protein]] * len(names)
 
-                if self.transform:
-                    img = self.transform(img)
+        self.labels = np.asarray(self.labels, dtype=np.int64)
 
-                self.images.append(img)
-                self.labels.append(self.prt2id[protein])
+        if self.storage == 'uint8':
+            self.images = read_shared_images(filenames, n_workers=n_workers, dtype=np.uint8)
+        else:
+            self.images = read_shared_images(filenames, n_workers=n_workers)
+            apply_transform(self.images, self.transform)
 
         
     def __len__(self):
-        return len(self.images)
+        return len(self.labels)
+
+    def get_image(self, idx):
+        if self.index is not None:
+            if self.storage == 'uint8':
+                return torch.from_numpy(self.images[self.index[idx]])
+            return packed_to_float(self.images[self.index[idx]], self.transform)
+        return self.images[idx]
 
     def __getitem__(self, idx):
 
         if self.conditional:
             # print(2*self.labels[idx] + (self.labels[idx] % 2), self.labels[idx])
-            return self.images[idx], self.labels[idx]#2*self.labels[idx] + (idx % 2) #self.labels[idx]
+            return self.get_image(idx), self.labels[idx]#2*self.labels[idx] + (idx % 2) #self.labels[idx]
         else:
-            return self.images[idx]#, 0, 0
+            return self.get_image(idx)#, 0, 0
+
+    def get_batch(self, indices):
+        if self.conditional:
+            return [self.get_images(indices), torch.from_numpy(self.labels[indices])]
+        return self.get_images(indices)
 
-class CIFAR(Dataset):
+class CIFAR(TensorImages, Dataset):
     """Points from multiple gaussians"""
 
     def __init__(self, selected=None, train=True, labeled=False):
         self.labeled = labeled
-
-        self.data = dset.CIFAR10(root = './cifar/',
-                         transform=transforms.Compose([
-                               # transforms.Scale(32),
-                               transforms.ToTensor(),
-                               transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                           ]),
-                          download = True, train=train)
-
-        if selected is not None:
-            if train:
-                labels = self.data.train_labels.numpy()
-            else:
-                labels = self.data.test_labels.numpy()
-            self.index = np.arange(len(self.data))[np.where(labels == selected)[0]]
-            # self.data = torch.masked_select(self.data.train_data, (self.data.train_labels == selected).view(-1, 1, 1)).view(-1, 1, 32, 32)
-        else:
-            self.index = np.arange(len(self.data))
-
-    def __len__(self):
-        return len(self.index)
+        self.select(*load_tensorized('cifar10', './cifar/', train), selected=selected)
 
     def __getitem__(self, idx):
         if self.labeled:
-            return self.data[self.index[idx]]
+            return self.images[self.index[idx]], self.labels[self.index[idx]]
         else:
-            return self.data[self.index[idx]][0]
+            return self.images[self.index[idx]]
+
+    def get_batch(self, indices):
+        idx = torch.from_numpy(self.index[indices])
+        if self.labeled:
+            return [self.images[idx], self.labels[idx]]
+        return self.images[idx]
 
-class LINwithdeletions(Dataset):
+class LINwithdeletions(ByteImages, Dataset):
     """Points from multiple gaussians"""
 
-    def __init__(self, basedir='/home/ubuntu/LIN_deletions/LIN_Normalized_all_size-128-512_train/', transform=None, raw=False, wo_deletions=[]):
+    def __init__(self, basedir='/home/ubuntu/LIN_deletions/LIN_Normalized_all_size-128-512_train/', transform=None, raw=False, wo_deletions=[], packed=None, n_workers=None, storage='float', manifest=None):
+        '''
+        packed: directory written by pack_images(basedir, packed, raw=raw), used instead of decoding basedir
+        n_workers: number of processes decoding the images, see read_images
+        storage: 'float' keeps normalized float32 images, 'uint8' keeps one uint8 (N, C, H, W)
+            tensor and leaves conversion and normalization to MyDataLoader
+        manifest: file of the Manifest of basedir, <basedir>.manifest.npz if None (e.g. a
+            writable path when basedir is on a read-only mount)
+        '''
+        self.check_storage(storage, transform)
+
 
         df = pd.read_csv('GO_terms.csv')
         df = df.fillna(0)
@@ -298,7 +1307,11 @@ class LINwithdeletions(Dataset):
         if not raw:
             basedir='/home/ubuntu/LIN_deletions_cropped/'
 
-        pairs = os.listdir(basedir)
+        if packed is not None:
+            x, pairs, dir_ids = load_pack(packed)
+        else:
+            manifest = Manifest(basedir, manifest)
+            pairs = manifest.dirs
         pairs = sorted(pairs)
 
         proteins = []
@@ -322,59 +1335,204 @@ class LINwithdeletions(Dataset):
         self.images = []
         self.gens = []
         self.deletions = []
+        self.transform = transform
+        self.index = None
+        self.class_indices = None
 
-        from time import time
+        if packed is not None:
+            dir2gen = np.array([self.prt2id[parse_pair(pair)[0]] for pair in pairs], dtype=np.int64)
+            dir2del = np.array([self.del2id.get(parse_pair(pair)[1], -1) for pair in pairs], dtype=np.int64)
 
-        from tqdm import tqdm
+            self.index = np.where(dir2del[dir_ids] >= 0)[0]
+            self.images = x
+            self.gens = dir2gen[dir_ids[self.index]]
+            self.deletions = dir2del[dir_ids[self.index]]
+            return
 
-        for pair in tqdm(pairs):
-            self.path = basedir + pair + '/'
-            filenames = list(filter(lambda x: (x.endswith('.jpg') or x.endswith('.jpeg') or x.endswith('.png')), os.listdir(self.path)))
-            self.transform = transform
+        filenames = []
 
-            gen = pair[2:].split('_D_')[0]
-            deletion = pair[2:].split('_D_')[1]
+        for pair in pairs:
+            self.path = basedir + pair + '/'
+            gen, deletion = parse_pair(pair)
 
             if deletion in wo_deletions:
                 continue
 
-            for filename in filenames:
-                # s = time()
-                img = imread(self.path + filename)
-                img = img_as_float(img)
-                # print(1, time()-s)
-                # s = time()
+            names = manifest.list_images(pair)
+
+            filenames += [self.path + filename for filename in names]
+            self.gens += [self.prt2id[gen]] * len(names)
+            self.deletions += [self.del2id[deletion]] * len(names)
 
-                if raw:
-                    img = img[16:-16,128:-128,:]
-                    img = resize(img, (48, 128))
+        self.gens = np.asarray(self.gens, dtype=np.int64)
+        self.deletions = np.asarray(self.deletions, dtype=np.int64)
 
-                # print(2, time()-s)
-                # s = time()
+        if self.storage == 'uint8':
+            self.images = read_shared_images(filenames, raw=raw, n_workers=n_workers, dtype=np.uint8)
+        else:
+            self.images = read_shared_images(filenames, raw=raw, n_workers=n_workers)
+            apply_transform(self.images, self.transform)
 
-                img = np.rollaxis(img[:,:,:2], 2, 0)
-                img = np.asarray(img, dtype=np.float32)
-                img = torch.from_numpy(img)
+        
+    def __len__(self):
+        return len(self.gens)
 
-                # print(3, time()-s)
-                # s = time()
+    def get_image(self, idx):
+        if self.index is not None:
+            if self.storage == 'uint8':
+                return torch.from_numpy(self.images[self.index[idx]])
+            return packed_to_float(self.images[self.index[idx]], self.transform)
+        return self.images[idx]
 
+    def __getitem__(self, idx):
+            return [self.get_image(idx), self.gens[idx], self.deletions[idx]]#, self.go_dict[self.id2prt[self.gens[idx]]]]
+            # return [self.images[idx], idx%44, (idx*idx)%44]
+
+    def get_batch(self, indices):
+        return [self.get_images(indices), torch.from_numpy(self.gens[indices]), torch.from_numpy(self.deletions[indices])]
+
+    def real_images(self, k, gen=None, deletion=None, rng=np.random):
+        '''
+        k random images of a gene, a deletion or a (gene, deletion) pair, given as
+        names or ids, as one float batch. Reads nothing from disk but a packed dataset's pages.
+        '''
+        assert gen is not None or deletion is not None
+
+        if self.class_indices is None:
+            n_deletions = len(self.del2id)
+            self.class_indices = {'gen': ClassIndex(self.gens), 'deletion': ClassIndex(self.deletions),
+                                  'pair': ClassIndex(self.gens * n_deletions + self.deletions)}
+
+        gen = self.prt2id.get(gen, gen)
+        deletion = self.del2id.get(deletion, deletion)
+
+        if deletion is None:
+            indices = self.class_indices['gen'].sample(gen, k, rng)
+        elif gen is None:
+            indices = self.class_indices['deletion'].sample(deletion, k, rng)
+        else:
+            indices = self.class_indices['pair'].sample(gen * len(self.del2id) + deletion, k, rng)
 
-                if self.transform:
-                    img = self.transform(img)
+        return self.finish_batch(self.get_images(np.sort(indices)))
 
-                # print(4, time()-s)
-                # s = time()
 
+class LINStream(ByteImages, IterableDataset):
+    """Samples of LINwithdeletions streamed from disk"""
 
-                self.images.append(img)
-                self.gens.append(self.prt2id[gen])
-                self.deletions.append(self.del2id[deletion])
+    def __init__(self, sharddir, transform=None, wo_deletions=[], shuffle_buffer=10000, seed=0, storage='float'):
+        '''
+        Streams [image, gen, deletion] samples from the shards written by update_shards
+        (e.g. update_shards(basedir, sharddir) without cropping for full resolution),
+        so the corpus never has to fit in memory.
+
+        Every epoch the shards are shuffled and dealt to the DataLoader workers, each
+        going to the worker with the fewest images so far (see deal). Each worker
+        reads its shards through a buffer of shuffle_buffer samples. The order depends only on seed, epoch and the number of workers.
+        Shuffling happens here, so use DataLoader(..., shuffle=False).
+        '''
+        self.check_storage(storage, transform)
+
+        pairs = list_shards(sharddir)
+
+        proteins = sorted(set(parse_pair(pair)[0] for pair in pairs))
+        deletions = sorted(set(parse_pair(pair)[1] for pair in pairs) - set(wo_deletions))
+
+        self.prt2id = dict(zip(proteins, range(len(proteins))))
+        self.id2prt = dict(zip(range(len(proteins)), proteins))
+        self.del2id = dict(zip(deletions, range(len(deletions))))
+
+        self.sharddir = sharddir
+        self.pairs = [pair for pair in pairs if parse_pair(pair)[1] not in wo_deletions]
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = 0, 1
+
+        self.lengths = np.array([len(np.load(os.path.join(sharddir, pair + '.names.npy'))) for pair in self.pairs], dtype=np.int64)
+        self.n_images = int(self.lengths.sum())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self, rank, world_size):
+        '''
+        Every rank streams a disjoint part of the shards, dealt after the epoch's shuffle.
+        All workers of all ranks yield the same number of samples, the largest part:
+        shorter parts start reading their shards again, so that no rank waits for the
+        others at the end of an epoch and no image is left out.
+        '''
+        self.rank, self.world_size = rank, world_size
 
-        
     def __len__(self):
-        return len(self.images)
+        return self.n_images
 
-    def __getitem__(self, idx):
-            return [self.images[idx], self.gens[idx], self.deletions[idx]]#, self.go_dict[self.id2prt[self.gens[idx]]]]
-            # return [self.images[idx], idx%44, (idx*idx)%44]
\ No newline at end of file
+    def to_sample(self, img, gen, deletion):
+        if self.storage == 'uint8':
+            img = torch.from_numpy(np.array(img))
+        else:
+            img = packed_to_float(img, self.transform)
+        return [img, gen, deletion]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+
+        # same shard order in every worker of every rank, then every worker takes its own part
+        part = self.rank * num_workers + worker_id
+        n_parts = self.world_size * num_workers
+
+        rng = np.random.RandomState([self.seed, self.epoch])
+        parts, sizes = self.deal(rng.permutation(len(self.pairs)), n_parts)
+        pairs = [self.pairs[i] for i in parts[part]]
+
+        rng = np.random.RandomState([self.seed, self.epoch, part + 1])
+        samples = self.stream(pairs, rng)
+
+        if self.world_size > 1:
+            # more parts than shards: an empty part reads the shards of the largest one
+            if not pairs:
+                pairs = [self.pairs[i] for i in parts[int(np.argmax(sizes))]]
+            samples = islice(chain(samples, chain.from_iterable(self.stream(pairs, rng) for _ in count())), int(sizes.max()))
+
+        for sample in samples:
+            yield self.to_sample(*sample)
+
+    def deal(self, order, n_parts):
+        '''
+        Deals the shards in order to n_parts parts: each goes to the part with the fewest
+        images so far, so parts differ by at most one shard. Returns the shard indices of
+        every part and the number of images of every part.
+        '''
+        parts = [[] for _ in range(n_parts)]
+        sizes = np.zeros(n_parts, dtype=np.int64)
+
+        for i in order:
+            p = int(np.argmin(sizes))
+            parts[p].append(i)
+            sizes[p] += self.lengths[i]
+        return parts, sizes
+
+    def stream(self, pairs, rng):
+        '''(image, gen, deletion) samples of the shards pairs, shuffled with rng'''
+        buffer = []
+
+        for pair in pairs:
+            shard = np.load(os.path.join(self.sharddir, pair + '.npy'), mmap_mode='r')
+            gen, deletion = parse_pair(pair)
+            gen, deletion = self.prt2id[gen], self.del2id[deletion]
+
+            for i in rng.permutation(len(shard)):
+                sample = (shard[i], gen, deletion)
+
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+
+                j = rng.randint(len(buffer))
+                buffer[j], sample = sample, buffer[j]
+                yield sample
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
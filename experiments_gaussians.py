@@ -38,8 +38,8 @@ opt = Options()
 
 # data = datasets.GaussianMixtureDataset(mean_list=mean_list, component_size_list=[100]*len(mean_list))
 
-# mydataloader = datasets.MyDataLoader()
-# data_iter = mydataloader.return_iterator(DataLoader(data, batch_size=opt.batch_size, shuffle=True, num_workers=1), is_cuda=opt.cuda)
+# # fresh batches drawn in one call each, no DataLoader
+# data_iter = data.batch_iterator(opt.batch_size, is_cuda=opt.cuda)
 
 
 # opt.path = 'gan251/'
@@ -106,8 +106,8 @@ opt = Options()
 
 # data = datasets.GaussianMixtureDataset(mean_list=mean_list, component_size_list=[500]*len(mean_list))
 
-# mydataloader = datasets.MyDataLoader()
-# data_iter = mydataloader.return_iterator(DataLoader(data, batch_size=opt.batch_size, shuffle=True, num_workers=1), is_cuda=opt.cuda)
+# # fresh batches drawn in one call each, no DataLoader
+# data_iter = data.batch_iterator(opt.batch_size, is_cuda=opt.cuda)
 
 
 # opt.path = 'lsgan251/'
@@ -171,8 +171,8 @@ opt = Options()
 
 # data = datasets.GaussianMixtureDataset(mean_list=mean_list, component_size_list=[100]*len(mean_list))
 
-# mydataloader = datasets.MyDataLoader()
-# data_iter = mydataloader.return_iterator(DataLoader(data, batch_size=opt.batch_size, shuffle=True, num_workers=1), is_cuda=opt.cuda)
+# # fresh batches drawn in one call each, no DataLoader
+# data_iter = data.batch_iterator(opt.batch_size, is_cuda=opt.cuda)
 
 
 # opt.path = 'wgangp25/'
@@ -1,3 +1,10 @@
+import contextlib
+import os
+import random
+import signal
+import sys
+import threading
+
 from time import time as time
 import numpy as np
 from tqdm import tqdm
@@ -12,6 +19,9 @@ from torchvision.utils import make_grid
 
 from tensorboardX import SummaryWriter
 
+from metrics import MetricsLog
+from checkpoint import CheckpointWriter, save_atomic
+
 
 class Options:
     def __init__(self):
@@ -28,11 +38,31 @@ class Options:
         self.conditional = False
         self.shuffle_labels = False
         self.checkpoints = []
+        self.state_every = 1000
+        self.precision = 'fp32' # 'fp32', 'bf16': forward passes under bfloat16 autocast
+        self.compile = False # netG and netD compiled with torch.compile, see GAN_base.compile_nets
+        self.compile_cache = '~/.cache/gans/compile'
         self.path = ''
         self.two_labels = False
         self.test_labels = False
         
 
+def unfinished_state(opt):
+    '''
+    opt.path + 'state.pth' if it holds a run stopped before opt.num_iter iterations, to be
+    passed to GAN_base.train(resume_from=...), else None: a finished run starts over
+    '''
+    filename = opt.path + 'state.pth'
+    if not os.path.exists(filename):
+        return None
+
+    i_iter = torch.load(filename, map_location='cpu', weights_only=False, mmap=True)['i_iter']
+    if i_iter >= opt.num_iter:
+        print('{} is from a finished run ({} iterations), not resuming'.format(filename, i_iter))
+        return None
+    return filename
+
+
 TENSORBOARD = True
 
 DATASET = 'MNIST' # 'MNIST', 'gaussians'
@@ -44,12 +74,60 @@ class GAN_base():
 
         self.opt = opt
 
+        # writes the checkpoints of save() in the background during train(), its thread
+        # is started by the first save and stopped at the end of train()
+        self.checkpoint_writer = CheckpointWriter()
+        self.in_train = False
+
         if self.opt is not None and self.opt.cuda:
             if self.netD is not None:
                 self.netD.cuda()
             if self.netG is not None:
                 self.netG.cuda()
 
+        self.compiled = False
+        if self.opt is not None and self.opt.compile:
+            self.compile_nets()
+
+
+    def compile_nets(self):
+        '''
+        Compiles netG and netD in place with torch.compile, for training and sampling
+        with any forward signature (noise, (x, y), (x, y1, y2)). Parameters and
+        state_dict keys do not change. The compiled kernels are cached on disk in
+        opt.compile_cache (the inductor cache), keyed by the traced graph and its input
+        shapes and dtypes, so later runs of the same nets and batch sizes load them
+        instead of compiling. Graphs are still traced at every start, which is cheap.
+        '''
+        if self.compiled:
+            return
+
+        if self.opt.compile_cache is not None:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(os.path.expanduser(self.opt.compile_cache))
+
+        for net in [self.netG, self.netD]:
+            if net is not None:
+                net.compile()
+        self.compiled = True
+
+
+    def eager(self):
+        '''context running the compiled nets eagerly, e.g. for double backward, which compiled graphs do not support'''
+        if not self.compiled:
+            return contextlib.nullcontext()
+        return torch.compiler.set_stance('force_eager')
+
+
+    def autocast(self):
+        '''
+        Context of the forward passes: bfloat16 autocast if opt.precision is 'bf16'.
+        Weights, gradients and optimizer states stay float32, and losses are reduced
+        in float32 (see train_D_one_step).
+        '''
+        assert self.opt.precision in ['fp32', 'bf16'], self.opt.precision
+        return torch.autocast('cuda' if self.opt.cuda else 'cpu', dtype=torch.bfloat16,
+                              enabled=self.opt.precision == 'bf16')
+
 
     def compute_disc_score(self, data_a, data_b):
         raise NotImplementedError
@@ -70,14 +148,15 @@ class GAN_base():
 
         # get data and scores
         data_a = next(iterator_a)
-        data_b = next(iterator_b)
+        with self.autocast():
+            data_b = next(iterator_b)
 
-        errD = self.compute_disc_score(data_a, data_b)
+            errD = self.compute_disc_score(data_a, data_b)
         
-        errD = errD.mean()
+        errD = errD.float().mean()
         errD.backward()
         self.optimizerD.step()
-        return errD.data[0], data_a, data_b
+        return errD.item(), data_a, data_b
 
 
     def train_G_one_step(self, iterator_fake, fake_images=None):
@@ -85,16 +164,17 @@ class GAN_base():
         for p in self.netD.parameters():
             p.requires_grad = False  # to avoid computation
 
-        if fake_images is None:
-            fake_images = next(iterator_fake)
-        errG = self.compute_gen_score(fake_images)
+        with self.autocast():
+            if fake_images is None:
+                fake_images = next(iterator_fake)
+            errG = self.compute_gen_score(fake_images).float()
 
         try:
             errG.backward()
             self.optimizerG.step()
         except:
             pass
-        return errG.data[0], fake_images
+        return errG.item(), fake_images
 
 
     def train_one_step(self, iterator_data, iterator_fake, num_disc_iters=1, i_iter=None):
@@ -107,7 +187,66 @@ class GAN_base():
         return errD, errG
 
 
-    def train(self, data_iter, opt=None, logger=None, callback=None):
+    def state_dict(self, i_iter, data_iter=None, logger=None, t_elapsed=0.):
+        '''everything needed to continue training after i_iter iterations, see train(resume_from=...)'''
+        state = {'i_iter': i_iter, 't_elapsed': t_elapsed}
+
+        for name in ['netG', 'netD', 'optimizerG', 'optimizerD']:
+            if getattr(self, name) is not None:
+                state[name] = getattr(self, name).state_dict()
+
+        # the power iteration vectors of spectral norm layers are not in state_dict()
+        for name in ['netG', 'netD']:
+            net = getattr(self, name)
+            if net is not None:
+                state[name + '_u'] = {k: m.u.data for k, m in net.named_modules() if getattr(m, 'u', None) is not None}
+
+        kind, keys, pos, has_gauss, cached = np.random.get_state()
+        state['rng'] = {'numpy': (kind, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached),
+                        'torch': torch.get_rng_state(),
+                        'python': random.getstate()}
+        if self.opt.cuda:
+            state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+
+        if data_iter is not None and hasattr(data_iter, 'state_dict'):
+            state['data'] = data_iter.state_dict()
+        if logger is not None:
+            state['logger'] = logger.state_dict()
+        return state
+
+
+    def load_state_dict(self, state, data_iter=None, logger=None):
+        for name in ['netG', 'netD', 'optimizerG', 'optimizerD']:
+            if name in state:
+                getattr(self, name).load_state_dict(state[name])
+
+        for name in ['netG', 'netD']:
+            net = getattr(self, name)
+            for k, u in state.get(name + '_u', {}).items():
+                m = net.get_submodule(k)
+                m.u = Variable(u.to(m.weight.device))
+
+        kind, keys, pos, has_gauss, cached = state['rng']['numpy']
+        np.random.set_state((kind, keys.numpy().astype(np.uint32), pos, has_gauss, cached))
+        torch.set_rng_state(state['rng']['torch'])
+        random.setstate(state['rng']['python'])
+        if self.opt.cuda and 'cuda' in state['rng']:
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+
+        if data_iter is not None and 'data' in state:
+            data_iter.load_state_dict(state['data'])
+        if logger is not None and 'logger' in state:
+            logger.load_state_dict(state['logger'])
+
+
+    def train(self, data_iter, opt=None, logger=None, callback=None, resume_from=None):
+        '''
+        Trains for opt.num_iter iterations. The full training state (see state_dict) is
+        written to opt.path + 'state.pth' every opt.state_every iterations, at the end and
+        on SIGTERM; train(..., resume_from=opt.path + 'state.pth') continues from it
+        exactly as if it had not stopped, for data_iter from MyDataLoader.return_iterator
+        over datasets whose batches depend only on their indices.
+        '''
         if opt is not None:
             self.opt = opt
 
@@ -124,42 +263,89 @@ class GAN_base():
             netD.cuda()
             netG.cuda()
 
+        if self.opt.compile:
+            self.compile_nets()
+
         # iterators
         iterator_data = data_iter   
+        # MyDataLoader behind data_iter, if any: reports the time spent waiting for data
+        loader = getattr(data_iter, 'loader', None)
         iterator_fake = self.fake_data_generator(opt.batch_size, opt.nz, iterator_data)
 
-        gen_score_history = []
-        disc_score_history = []
+        start, t_elapsed = 0, 0.
+        if resume_from is not None:
+            state = torch.load(resume_from, map_location='cpu', weights_only=False)
+            self.load_state_dict(state, data_iter, logger)
+            start, t_elapsed = state['i_iter'], state['t_elapsed']
+
+        # one record per iteration, appended to opt.path + 'metrics.bin' (see metrics.read_metrics)
+        fields = ['iter', 'errD', 'errG', 'time'] + (['data_wait'] if loader is not None else [])
+        metrics = MetricsLog(self.opt.path + 'metrics.bin', fields, meta={'visualize_nth': self.opt.visualize_nth},
+                             append=resume_from is not None, keep=start)
+
+        def save_state(i_iter):
+            metrics.flush()
+            # the state only holds the lengths of the logger's series
+            if logger is not None:
+                logger.save()
+            self.checkpoint_writer.save(self.state_dict(i_iter, data_iter, logger, time() - t_start),
+                                        self.opt.path + 'state.pth')
+
+        # on SIGTERM (e.g. preemption) the state is saved after the current iteration
+        terminated = []
+        main_thread = threading.current_thread() is threading.main_thread()
+        if main_thread:
+            previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: terminated.append(signum))
 
         # main loop
-        t_start = time()
-        time_history = []
+        t_start = time() - t_elapsed
+        self.in_train = True
 
-        for i_iter in tqdm(range(opt.num_iter)):
+        try:
+            for i_iter in tqdm(range(start, opt.num_iter), initial=start, total=opt.num_iter):
 
-            if (i_iter + 1) in self.opt.checkpoints:
-                self.save(i_iter + 1)
+                if terminated:
+                    save_state(i_iter)
+                    sys.exit(128 + terminated[0])
 
-            errD, errG = self.train_one_step(iterator_data, iterator_fake,
-                                             num_disc_iters=opt.num_disc_iters, i_iter=i_iter)
+                if i_iter > start and i_iter % self.opt.state_every == 0:
+                    save_state(i_iter)
 
-            if TENSORBOARD:
-                writer.add_scalar('disc_loss', errD, i_iter)
-                writer.add_scalar('gen_loss', errG, i_iter)
+                if (i_iter + 1) in self.opt.checkpoints:
+                    self.save(i_iter + 1)
 
-            if logger is not None:
-                logger.add('disc_loss', errD, i_iter)
-                logger.add('gen_loss', errG, i_iter)
+                errD, errG = self.train_one_step(iterator_data, iterator_fake,
+                                                 num_disc_iters=opt.num_disc_iters, i_iter=i_iter)
 
-            if callback is not None:
-                callback(self, i_iter)
+                if TENSORBOARD:
+                    writer.add_scalar('disc_loss', errD, i_iter)
+                    writer.add_scalar('gen_loss', errG, i_iter)
+                    if loader is not None:
+                        writer.add_scalar('data_wait', loader.wait_time, i_iter)
 
-            gen_score_history.append(errG)
-            disc_score_history.append(errD)
-            time_history.append(time() - t_start)
+                if logger is not None:
+                    logger.add('disc_loss', errD, i_iter)
+                    logger.add('gen_loss', errG, i_iter)
+                    if loader is not None:
+                        logger.add('data_wait', loader.wait_time, i_iter)
+
+                if callback is not None:
+                    callback(self, i_iter)
+
+                if loader is not None:
+                    metrics.add(i_iter, errD, errG, time() - t_start, loader.wait_time)
+                else:
+                    metrics.add(i_iter, errD, errG, time() - t_start)
+
+            save_state(opt.num_iter)
+        finally:
+            # also when training fails or exits on SIGTERM
+            metrics.close()
+            if main_thread:
+                signal.signal(signal.SIGTERM, previous_handler)
+            self.in_train = False
+            self.checkpoint_writer.close()
 
-            np.save(self.opt.path + 'loss.pkl', np.asarray([self.opt.visualize_nth] + gen_score_history + disc_score_history + time_history))
-                
         if TENSORBOARD:
             writer.close()
 
@@ -167,10 +353,18 @@ class GAN_base():
 
 
     def save(self, tag):
-        if self.netG is not None:
-            torch.save(self.netG.state_dict(), self.opt.path + 'gen_{}.pth'.format(tag))
-        if self.netD is not None:
-            torch.save(self.netD.state_dict(), self.opt.path + 'disc_{}.pth'.format(tag))
+        '''
+        saves the weights, during train() as snapshots written by self.checkpoint_writer
+        (on disk once train() returns), otherwise right away
+        '''
+        for net, name in [(self.netG, 'gen'), (self.netD, 'disc')]:
+            if net is None:
+                continue
+            filename = self.opt.path + '{}_{}.pth'.format(name, tag)
+            if self.in_train:
+                self.checkpoint_writer.save(net.state_dict(), filename)
+            else:
+                save_atomic(net.state_dict(), filename)
 
 
     def join_xy(self, batch):
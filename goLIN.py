@@ -18,6 +18,7 @@ from layers.SNConv2d import SNConv2d
 from layers.SNLinear import SNLinear
 
 from layers.separable import ConvTranspose2d_separable
+from layers.GOEmbedding import GOEmbedding, load_go_terms
 
 
 import datasets
@@ -51,7 +52,7 @@ def join_xy(x, y, n_classes):
 
 
 class LINnet_G(nn.Module):
-    def __init__(self, nc=1, ngf=64, nz=100, bias=False, n_gens=41,n_deletions=34): # 256 ok
+    def __init__(self, go, nc=1, ngf=64, nz=100, bias=False, n_gens=41,n_deletions=34): # 256 ok
         super(LINnet_G,self).__init__()
         self.n_gens=n_gens
         self.n_deletions=n_deletions
@@ -86,22 +87,13 @@ class LINnet_G(nn.Module):
                                  # nn.Sigmoid())
                                  nn.Tanh())
 
-        self.go_embedding = nn.Linear(295, n_gens)
+        # go: (n_gens x 295) GO vectors of the gens, see load_go_terms
+        self.go_embedding = GOEmbedding(go, n_gens)
         self.apply(weights_init)
 
     def forward(self, x, y1, y2):
 
-
-        go = np.zeros((x.size(0), 295), dtype=np.float32)
-        # print(go.shape)
-        for i, y in enumerate(y1):
-            # print(i)
-            go[i,:] = data.go_dict[data.id2prt[y1.data[i]]]
-
-        go = torch.autograd.Variable(torch.from_numpy(go)).cuda()
-
-
-        y = self.go_embedding(go)
+        y = self.go_embedding(y1)
 
         h1 = x[:,:self.nz//2,:,:]
         h2 = torch.cat([h1, x[:,self.nz//2:,:,:], y.view(y.size(0), y.size(1), 1, 1)], dim=1)
@@ -125,7 +117,7 @@ class LINnet_G(nn.Module):
 
 
 class LINnet_D(nn.Module):
-    def __init__(self,nc=1,ndf=64,BN=True,bias=False,n_gens=41,n_deletions=34): # 128 ok
+    def __init__(self,go,nc=1,ndf=64,BN=True,bias=False,n_gens=41,n_deletions=34): # 128 ok
         super(LINnet_D,self).__init__()
 
         self.n_gens=n_gens
@@ -157,7 +149,8 @@ class LINnet_D(nn.Module):
         # self.embedding2.weight.data.normal_(0,1)
         # self.linear = nn.Linear(ndf*8, 1, bias=True)
 
-        self.go_embedding = nn.Linear(295, n_gens)
+        # go: (n_gens x 295) GO vectors of the gens, see load_go_terms
+        self.go_embedding = GOEmbedding(go, n_gens)
 
         # self.linear = nn.Linear(ndf*8, 1, bias=False)
         # self.linear = nn.Linear(ndf*8+n_classes, 1, bias=False)
@@ -166,14 +159,7 @@ class LINnet_D(nn.Module):
 
     def forward(self, x, y1, y2):
 
-        go = np.zeros((x.size(0), 295), dtype=np.float32)
-
-        for i, y in enumerate(y1):
-            go[i,:] = data.go_dict[data.id2prt[y1.data[i]]]
-
-        go = torch.autograd.Variable(torch.from_numpy(go)).cuda()
-            
-        y = self.go_embedding(go)
+        y = self.go_embedding(y1)
 
         h = self.layer1(x)
         h = self.layer2(h)
@@ -260,38 +246,27 @@ data = datasets.LINwithdeletions(transform=transforms.Normalize((0.5, 0.5, 0.5),
 
 # print(data.deletions)
 #['Alp14', 'Arp3', 'Cki2', 'Mkh1', 'Sid2', 'Tea1', 'Act1', 'Gef1', 'For3', 'Ras1', 'Scd2', 'Tip1']
+# rare (gene, deletion) pairs are drawn as often as the common ones
+sampler = datasets.BalancedBatchSampler(data.gens, data.deletions, opt.batch_size, weighting='pairs')
+
+# whole-batch augmentation on the GPU, e.g. datasets.BatchAugment(translate=2, jitter=0.05, value_range=(-1, 1))
+augment = None
+
 mydataloader = datasets.MyDataLoader()
-data_iter = mydataloader.return_iterator(DataLoader(data, batch_size=opt.batch_size, shuffle=True, num_workers=4), is_cuda=opt.cuda, conditional=opt.conditional, pictures=True)
+data_iter = mydataloader.return_iterator(DataLoader(data, batch_sampler=sampler, num_workers=4), is_cuda=opt.cuda, conditional=opt.conditional, pictures=True, augment=augment)
 
 # netG = mnistnet.Generator(nz=100, BN=True)
 # netD = mnistnet.Discriminator(nc=1, BN=True)
-netG = LINnet_G(nc=2,nz=100,n_gens=41, n_deletions=34)
-netD = LINnet_D(nc=2,BN=True,n_gens=41, n_deletions=34)
+go = load_go_terms('GO_terms.csv', [data.id2prt[i] for i in range(len(data.id2prt))])
+
+netG = LINnet_G(go, nc=2,nz=100,n_gens=41, n_deletions=34)
+netD = LINnet_D(go, nc=2,BN=True,n_gens=41, n_deletions=34)
 
 
 optimizerD = optim.Adam(netD.parameters(), lr=2e-4, betas=(.5, .999))
 optimizerG = optim.Adam(netG.parameters(), lr=2e-4, betas=(.5, .999))
 
 
-import pandas as pd
-df = pd.read_csv('GO_terms.csv')
-df = df.fillna(0)
-
-names = df['Unnamed: 0']
-
-df = df.drop(['Unnamed: 0'], axis=1)
-
-# print(df.as_matrix())
-go = np.asarray(df.as_matrix(),dtype=int)
-# print(go.shape)
-# print(len(df.columns))
-
-go_dict = dict()
-
-for i, name in enumerate(df.columns):
-    go_dict[name] = go[:,i]
-
-
 def save_samples(gan, i_iter):
     gan.netG.eval()
 
@@ -344,8 +319,8 @@ def callback(gan, i_iter):
     #     save_inception_score(gan, i_iter)
 
     if i_iter % 200 == 0:
-        torch.save(netD.embedding1.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
-        torch.save(netD.embedding2.state_dict(), opt.path + '2emb{}.pth'.format(i_iter))
+        gan.checkpoint_writer.save(netD.embedding1.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
+        gan.checkpoint_writer.save(netD.embedding2.state_dict(), opt.path + '2emb{}.pth'.format(i_iter))
 
     if i_iter % 200 == 0:
         save_samples(gan, i_iter)
@@ -356,7 +331,8 @@ def callback(gan, i_iter):
 
 gan1 = gan.GAN(netG=netG, netD=netD, optimizerD=optimizerD, optimizerG=optimizerG, opt=opt)
 
-gan1.train(data_iter, opt, logger=log, callback=callback)
+# continue a preempted run from its last state
+gan1.train(data_iter, opt, logger=log, callback=callback, resume_from=gan.unfinished_state(opt))
 
 torch.save(netG.state_dict(), opt.path + 'gen.pth')
 torch.save(netD.state_dict(), opt.path + 'disc.pth')
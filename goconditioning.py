@@ -49,19 +49,6 @@ def join_xy(x, y, n_classes):
 
     return torch.cat((x, torch.autograd.Variable(y_onehot.expand(x.size()[0], n_classes, x.size()[2], x.size()[3]))), 1)
 
-def label2go2embedding(y, embedding_layer):
-
-    n_classes = embedding_layer.weight.data.size()
-
-    th = torch.cuda if y.is_cuda else torch
-    y_onehot1 = th.FloatTensor(y.size()[0], emb)
-    y_onehot1.zero_()
-    y_onehot1.scatter_(1, y1.data.view(-1,1), 1)
-    y_onehot1 = Variable(y_onehot1)
-
-
-    pass
-
 class LINnet_G(nn.Module):
     def __init__(self, nc=1, ngf=64, nz=100, bias=False, n_gens=41,n_deletions=34): # 256 ok
         super(LINnet_G,self).__init__()
@@ -248,8 +235,14 @@ data = datasets.LINwithdeletions(transform=transforms.Normalize((0.5, 0.5, 0.5),
 
 # print(data.deletions)
 #['Alp14', 'Arp3', 'Cki2', 'Mkh1', 'Sid2', 'Tea1', 'Act1', 'Gef1', 'For3', 'Ra1', 'Scd2', 'Tip1']
+# rare (gene, deletion) pairs are drawn as often as the common ones
+sampler = datasets.BalancedBatchSampler(data.gens, data.deletions, opt.batch_size, weighting='pairs')
+
+# whole-batch augmentation on the GPU, e.g. datasets.BatchAugment(translate=2, jitter=0.05, value_range=(-1, 1))
+augment = None
+
 mydataloader = datasets.MyDataLoader()
-data_iter = mydataloader.return_iterator(DataLoader(data, batch_size=opt.batch_size, shuffle=True, num_workers=4), is_cuda=opt.cuda, conditional=opt.conditional, pictures=True)
+data_iter = mydataloader.return_iterator(DataLoader(data, batch_sampler=sampler, num_workers=4), is_cuda=opt.cuda, conditional=opt.conditional, pictures=True, augment=augment)
 
 # netG = mnistnet.Generator(nz=100, BN=True)
 # netD = mnistnet.Discriminator(nc=1, BN=True)
@@ -304,8 +297,8 @@ def callback(gan, i_iter):
     #     save_inception_score(gan, i_iter)
 
     if i_iter % 200 == 0:
-        torch.save(netD.embedding1.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
-        torch.save(netD.embedding2.state_dict(), opt.path + '2emb{}.pth'.format(i_iter))
+        gan.checkpoint_writer.save(netD.embedding1.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
+        gan.checkpoint_writer.save(netD.embedding2.state_dict(), opt.path + '2emb{}.pth'.format(i_iter))
 
     if i_iter % 200 == 0:
         save_samples(gan, i_iter)
@@ -316,7 +309,8 @@ def callback(gan, i_iter):
 
 gan1 = gan.GAN(netG=netG, netD=netD, optimizerD=optimizerD, optimizerG=optimizerG, opt=opt)
 
-gan1.train(data_iter, opt, logger=log, callback=callback)
+# continue a preempted run from its last state
+gan1.train(data_iter, opt, logger=log, callback=callback, resume_from=gan.unfinished_state(opt))
 
 torch.save(netG.state_dict(), opt.path + 'gen.pth')
 torch.save(netD.state_dict(), opt.path + 'disc.pth')
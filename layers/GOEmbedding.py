@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+import torch
+
+from torch import nn
+from torch.nn import functional as F
+
+
+def load_go_terms(filename='GO_terms.csv', proteins=None):
+    '''
+    Reads the (GO term x protein) table and returns a float32 (n_proteins x n_terms)
+    array with one row per protein, in the order of proteins (all columns if None).
+    '''
+    df = pd.read_csv(filename)
+    df = df.fillna(0)
+    df = df.drop(['Unnamed: 0'], axis=1)
+
+    if proteins is None:
+        proteins = list(df.columns)
+
+    return np.asarray(df[proteins].values.T, dtype=np.float32)
+
+
+class GOEmbedding(nn.Module):
+    '''
+    nn.Linear(n_terms, out_features) applied to the GO vector of a protein label.
+    The GO vectors live in a (n_proteins x n_terms) buffer on the module's device and
+    a batch of labels is mapped to them with one gather. sparse=True computes the same
+    with an embedding bag over the non-zero GO terms only. Parameters are named like
+    nn.Linear's, so checkpoints of a plain nn.Linear go_embedding still load.
+    '''
+    def __init__(self, go, out_features, bias=True, sparse=False):
+        super(GOEmbedding, self).__init__()
+
+        go = torch.FloatTensor(np.asarray(go, dtype=np.float32))
+        n_proteins, n_terms = go.size()
+
+        self.sparse = sparse
+        self.n_terms = n_terms
+        self.out_features = out_features
+
+        linear = nn.Linear(n_terms, out_features, bias=bias)
+        self.weight = linear.weight
+        self.bias = linear.bias
+
+        self.register_buffer('go', go, persistent=False)
+
+        # the non-zero terms of every protein, stored row after row
+        nonzero = go.nonzero()
+        counts = torch.bincount(nonzero[:,0], minlength=n_proteins)
+
+        self.register_buffer('terms', nonzero[:,1].contiguous(), persistent=False)
+        self.register_buffer('values', go[nonzero[:,0], nonzero[:,1]], persistent=False)
+        self.register_buffer('counts', counts, persistent=False)
+        self.register_buffer('starts', torch.cumsum(counts, 0) - counts, persistent=False)
+
+    def forward(self, y):
+        y = y.view(-1)
+
+        if not self.sparse:
+            return F.linear(self.go[y], self.weight, self.bias)
+
+        counts = self.counts[y]
+        offsets = torch.cumsum(counts, 0) - counts
+
+        # position in self.terms of every non-zero term of every label in the batch
+        pos = torch.repeat_interleave(self.starts[y] - offsets, counts) + torch.arange(int(counts.sum()), device=y.device)
+
+        out = F.embedding_bag(self.terms[pos], self.weight.t().contiguous(), offsets, mode='sum', per_sample_weights=self.values[pos])
+
+        if self.bias is not None:
+            out = out + self.bias
+        return out
@@ -38,7 +38,7 @@ def _l2normalize(v, eps=1e-12):
 
 def max_singular_value(W, u=None, Ip=1, cuda=True):
     """
-    Apply power iteration for the weight parameter
+    Apply power iteration for the weight parameter, in float32 also under autocast
     """
     if not Ip >= 1:
         raise ValueError("The number of power iterations should be positive integer")
@@ -48,11 +48,14 @@ def max_singular_value(W, u=None, Ip=1, cuda=True):
         if cuda:
             u = u.cuda()
     
-    for _ in range(Ip):
-        v = _l2normalize(torch.matmul(u, W))
-        u = _l2normalize(torch.matmul(v, W.transpose(0,1)))
+    with torch.autocast(W.device.type, enabled=False):
+        W, u = W.float(), u.float()
+
+        for _ in range(Ip):
+            v = _l2normalize(torch.matmul(u, W))
+            u = _l2normalize(torch.matmul(v, W.transpose(0,1)))
     
-    sigma = torch.sum(torch.matmul(torch.matmul(u, W), v.transpose(0,1)))
+        sigma = torch.sum(torch.matmul(torch.matmul(u, W), v.transpose(0,1)))
 
     return sigma, u, v
 
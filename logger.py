@@ -36,6 +36,25 @@ class Logger():
 		self.store[name]['timestamps'].append(time() - self.t0)
 
 
+	def state_dict(self):
+		'''the length of every series, the values themselves are in the file written by save()'''
+		lengths = {name: len(series['values']) for name, series in self.store.items()}
+		return {'lengths': lengths, 'elapsed': time() - self.t0}
+
+
+	def load_state_dict(self, state):
+		'''reads the series back from the file written by save(), cut to the lengths in state'''
+		store = dict()
+		if os.path.exists(self.filename):
+			store = _pickle.load(open(self.filename, 'rb'))['store']
+
+		self.store = dict()
+		for name, n in state['lengths'].items():
+			if name in store:
+				self.store[name] = {key: values[:n] for key, values in store[name].items()}
+		self.t0 = time() - state['elapsed']
+
+
 	def load(self, filename):
 		self.filename = filename
 		log = _pickle.load(open(self.filename, 'rb'))
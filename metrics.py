@@ -0,0 +1,91 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+
+MAGIC = b'GANMETR1'
+
+
+def _read_header(f):
+    magic = f.read(len(MAGIC))
+    assert magic == MAGIC, 'not a metrics log'
+    size, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(size).decode('utf-8'))
+    return header, len(MAGIC) + 4 + size
+
+
+class MetricsLog():
+    '''
+    Append-only log of fixed records, one float64 per field (e.g. iteration, errD,
+    errG, wall time). Records are buffered and written every flush_every adds, so
+    adding costs the same however long the run is. A process killed without
+    close() (e.g. SIGKILL) loses up to flush_every - 1 records. The file starts with a small json
+    header holding the field names and meta. An existing log is replaced, unless
+    append is set: then its first keep records (all if None) are kept and new ones
+    are added after them. Read it with read_metrics.
+    '''
+    def __init__(self, filename, fields, flush_every=100, meta=None, append=False, keep=None):
+        self.filename = filename
+        self.fields = list(fields)
+        self.buffer = np.zeros((flush_every, len(self.fields)), dtype='<f8')
+        self.n_buffered = 0
+
+        record_size = self.buffer.itemsize * len(self.fields)
+
+        if append and os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as f:
+                header, offset = _read_header(f)
+            assert header['fields'] == self.fields, '{} has fields {}'.format(filename, header['fields'])
+
+            # drop a record cut by a killed run
+            n_records = (os.path.getsize(filename) - offset) // record_size
+            if keep is not None:
+                n_records = min(n_records, keep)
+            with open(filename, 'r+b') as f:
+                f.truncate(offset + n_records * record_size)
+        else:
+            header = json.dumps({'fields': self.fields, 'meta': meta or {}}).encode('utf-8')
+            with open(filename, 'wb') as f:
+                f.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+        self.file = open(filename, 'ab')
+
+    def add(self, *values):
+        '''appends one record, values in the order of fields'''
+        self.buffer[self.n_buffered] = values
+        self.n_buffered += 1
+
+        if self.n_buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.n_buffered].tobytes())
+        self.file.flush()
+        self.n_buffered = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def read_metrics(filename):
+    '''memory-maps a MetricsLog file as a record array, e.g. read_metrics(filename)['errD']'''
+    with open(filename, 'rb') as f:
+        header, offset = _read_header(f)
+
+    dtype = np.dtype([(field, '<f8') for field in header['fields']])
+    n = (os.path.getsize(filename) - offset) // dtype.itemsize
+
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+
+def read_meta(filename):
+    '''the fields and meta dict a MetricsLog was created with'''
+    with open(filename, 'rb') as f:
+        header, _ = _read_header(f)
+    return header
@@ -39,50 +39,34 @@ class multichannel_CIFAR(Dataset):
 
         super(multichannel_CIFAR, self).__init__()
 
-        mnist = dset.CIFAR10(root = './data/',
-                         transform=transforms.Compose([
-                               transforms.Scale(32),
-                               transforms.ToTensor(),
-                               transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                           ]),
-                          download = True, train=train)
+        mnist = dset.CIFAR10(root = './data/', download = True, train=train)
 
-        if train:
-            onechannel_images = mnist.train_data#.view(-1, 1, 28, 28)
-            original_labels = mnist.train_labels
-        else:
-            onechannel_images = mnist.test_data#.view(-1, 1, 28, 28)
-            original_labels = mnist.test_labels
+        # the split selected by train
+        onechannel_images = mnist.data
+        original_labels = mnist.targets
 
-        onechannel_images = np.rollaxis(onechannel_images, 3, 1)
-        
-        onechannel_images = torch.FloatTensor(onechannel_images)
+        # ToTensor + Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)) on the whole uint8 array at once
+        onechannel_images = torch.from_numpy(np.ascontiguousarray(np.rollaxis(onechannel_images, 3, 1)))
+        onechannel_images = onechannel_images.float().div_(127.5).sub_(1)
 
-        original_labels = torch.LongTensor(original_labels)
-
-        # transform = transforms.Compose([
-        #                        transforms.ToPILImage(),
-        #                        transforms.Scale(32),
-        #                        transforms.ToTensor(),
-        #                        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        #                    ])
-
-        # onechannel_images = torch.stack([transform(image) for image in onechannel_images], dim=0).view(-1, 1, 3, 32, 32)
-
-        onechannel_images = torch.stack([mnist[i][0] for i in range(len(onechannel_images))], dim=0).view(-1, 1, 3, 32, 32)        
-
-        multichannel_images = torch.FloatTensor(len(onechannel_images), 10, 3, 32, 32)
-        multichannel_images.scatter_(1, original_labels.view(-1,1,1,1,1).expand(len(onechannel_images), 1, 3, 32, 32), onechannel_images)
-
-        multichannel_images = multichannel_images.view(len(onechannel_images), 30, 32, 32)
-        # print(multichannel_images.min(), multichannel_images.max())
-        self.x = multichannel_images
+        # images are kept with their class, the 30-channel tensor is built per batch in finish_batch
+        self.x = onechannel_images.share_memory_()
+        self.y = torch.LongTensor(original_labels).share_memory_()
 
     def __len__(self):
         return len(self.x)
 
     def __getitem__(self, idx):
-        return self.x[idx]
+        return self.x[idx], self.y[idx]
+
+    def get_batch(self, indices):
+        idx = torch.from_numpy(indices)
+        return [self.x[idx], self.y[idx]]
+
+    def finish_batch(self, batch):
+        '''puts every image into the 3 channels of its class out of 10'''
+        x, y = batch
+        return datasets.expand_channels(x, y, 10)
 
 
 
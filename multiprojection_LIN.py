@@ -42,7 +42,8 @@ def weights_init(m):
 class multichannel_LIN(Dataset):
     """Points from multiple gaussians"""
 
-    def __init__(self, proteins=['Arp3'], basedir='/home/ubuntu/LIN/LIN_Normalized_WT_size-48-80_train/', transform=None, conditional=False):
+    def __init__(self, proteins=['Arp3'], basedir='/home/ubuntu/LIN/LIN_Normalized_WT_size-48-80_train/', transform=None, conditional=False, n_workers=None, manifest=None):
+        # manifest: file of the datasets.Manifest of basedir, <basedir>.manifest.npz if None
         self.images = []
         self.conditional = conditional
         self.prt2id = dict(zip(proteins, range(len(proteins))))
@@ -50,29 +51,25 @@ class multichannel_LIN(Dataset):
         self.images = []
         self.labels = []
 
+        filenames = []
+        manifest = datasets.Manifest(basedir, manifest)
+
         for protein in proteins:
             self.path = basedir + protein + '/'
-            filenames = list(filter(lambda x: (x.endswith('.jpg') or x.endswith('.jpeg') or x.endswith('.png')), os.listdir(self.path)))
+            names = manifest.list_images(protein)
             self.transform = transform
 
-            for filename in filenames:
-                img = imread(self.path + filename)
-                # img = resize(img, (24, 40))
-                img = img_as_float(img)
-                img = np.rollaxis(img[:,:,:2], 2, 0) #.reshape((2, 24, 40))
-                img = np.asarray(img, dtype=np.float32)
-                img = torch.from_numpy(img)
-
-                if self.transform:
-                    img = self.transform(img)
+            filenames += [self.path + filename for filename in names]
+            self.labels += [self.prt2id[protein]] * len(names)
 
-                self.images.append(img)
-                self.labels.append(self.prt2id[protein])
+        self.images = datasets.read_shared_images(filenames, n_workers=n_workers)
+        datasets.apply_transform(self.images, self.transform)
 
 
-        original_images = torch.stack(self.images, dim=0)
+        original_images = self.images
 
         original_labels = torch.LongTensor(self.labels)
+        self.labels = original_labels
 
         # second_channel = torch.stack([self.images[i][1,:,:] for i in range(len(original_images))], dim=0).view(-1, 1, 48, 80)
 
@@ -92,15 +89,20 @@ class multichannel_LIN(Dataset):
         return len(self.images)
 
     def __getitem__(self, idx):
+        # compact sample: the two channels and the protein index, expanded in finish_batch
+        return self.x[idx], self.y[idx]
 
-        t = torch.FloatTensor(1 + len(self.proteins), 48, 80).zero_()
-        t[0,:,:] = self.x[idx,0,:,:]
-        t[1+self.y[idx],:,:] = self.x[idx,1,:,:]
+    def get_batch(self, indices):
+        idx = torch.from_numpy(indices)
+        return [self.x[idx], self.y[idx]]
 
+    def finish_batch(self, batch):
+        '''builds the (B, 1 + len(proteins), H, W) batch from compact samples'''
+        x, y = batch
+        t = datasets.expand_channels(x, y, len(self.proteins), n_shared=1)
         if self.conditional:
-            return t, self.labels[idx]
-        else:
-            return t
+            return [t, y]
+        return t
 
 
 
@@ -216,7 +218,7 @@ opt.checkpoints = [1000, 2000, 5000, 10000, 20000, 40000, 60000, 100000, 150000,
 
 log = Logger(base_dir=opt.path, tag='multiGAN')
 
-proteins = os.listdir('../LIN/LIN_Normalized_WT_size-48-80_train/')
+proteins = datasets.Manifest('../LIN/LIN_Normalized_WT_size-48-80_train/').dirs
 # data = multichannel_LIN(proteins=['Alp14', 'Arp3', 'Cki2', 'Mkh1', 'Sid2', 'Tea1'], transform=transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
 data = multichannel_LIN(proteins=proteins, transform=transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
 # data = datasets.LINDataset(proteins=['Alp14', 'Arp3', 'Cki2', 'Mkh1', 'Sid2', 'Tea1'], transform=transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), conditional=opt.conditional)
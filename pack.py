@@ -0,0 +1,12 @@
+# Packs the LIN datasets once, so that datasets.LINDataset(packed=...) and
+# datasets.LINwithdeletions(packed=...) open a memory-mapped array instead of
+# decoding every jpeg on startup. Rerun after the image folders change: only
+# new or changed folders are decoded again.
+
+import datasets
+
+datasets.pack_images('/home/ubuntu/LIN_deletions_cropped/', '/home/ubuntu/LIN_deletions_packed/')
+# datasets.pack_images('/home/ubuntu/LIN_deletions/LIN_Normalized_all_size-128-512_train/', '/home/ubuntu/LIN_deletions_packed/', raw=True)
+
+datasets.pack_images('/home/ubuntu/LIN/LIN_Normalized_WT_size-48-80_train/', '/home/ubuntu/LIN_packed/')
+# datasets.pack_images('/home/ubuntu/LIN128/LIN_Normalized_WT_size-96-160_train/', '/home/ubuntu/LIN128_packed/')
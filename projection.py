@@ -189,7 +189,7 @@ def callback(gan, i_iter):
     #     save_inception_score(gan, i_iter)
 
     if i_iter % 50 == 0:
-        torch.save(netD.embedding.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
+        gan.checkpoint_writer.save(netD.embedding.state_dict(), opt.path + 'emb{}.pth'.format(i_iter))
         # torch.save(netD.embedding2.state_dict(), opt.path + '2emb{}.pth'.format(i_iter))
 
     if i_iter % 50 == 0:
@@ -12,13 +12,20 @@ from skimage.transform import resize
 import os
 import numpy as np
 
+import datasets
+
 # basedir = '/home/ubuntu/LIN_deletions/LIN_Normalized_all_size-128-512_train/'
 basedir = '/home/ubuntu/LIN_deletions_cropped/'
 
+# take the real images from the pack written by pack.py instead of decoding jpegs
+packdir = None
+# packdir = '/home/ubuntu/LIN_deletions_packed/'
+
 # if not os.path.exists(basedir):
 # 	os.makedirs(basedir)
 
-pairs = os.listdir(basedir)
+manifest = datasets.Manifest(basedir)
+pairs = manifest.dirs
 pairs = sorted(pairs)
 
 proteins = []
@@ -52,7 +59,7 @@ deletion_filenames = dict()
 
 for pair in tqdm(pairs):
     path = basedir + pair + '/'
-    filenames = list(filter(lambda x: (x.endswith('.jpg') or x.endswith('.jpeg') or x.endswith('.png')), os.listdir(path)))
+    filenames = manifest.list_images(pair)
 
     if not os.path.exists(basedir + pair + '/'):
         os.makedirs(basedir + pair + '/')
@@ -60,24 +67,29 @@ for pair in tqdm(pairs):
     gen = pair[2:].split('_D_')[0]
     deletion = pair[2:].split('_D_')[1]
 
-    for filename in filenames:
-        deletion_filenames[deletion] = deletion_filenames.get(deletion, []) + [path + filename]
+    deletion_filenames.setdefault(deletion, []).extend(path + filename for filename in filenames)
+
 
+tmp = torch.FloatTensor(35, 20, 3, 48, 128).zero_()
 
-tmp = torch.FloatTensor(35, 20, 3, 48, 128)
+if packdir is not None:
+    data = datasets.LINwithdeletions(packed=packdir)
 
-j = 0
-for key, value in deletion_filenames.items():
-    indices = np.random.permutation(len(value))
-    for i in range(20):
-        img = imread(value[indices[i]])
+    for j, key in enumerate(deletion_filenames):
+        tmp[j,:,:2,:,:] = data.real_images(20, deletion=key)
+else:
+    j = 0
+    for key, value in deletion_filenames.items():
+        indices = np.random.permutation(len(value))
+        for i in range(20):
+            img = imread(value[indices[i]])
 
-        img = img_as_float(img)
-        img = np.rollaxis(img, 2, 0)
+            img = img_as_float(img)
+            img = np.rollaxis(img, 2, 0)
 
-        tmp[j,i,:,:,:] = torch.from_numpy(img)
+            tmp[j,i,:,:,:] = torch.from_numpy(img)
 
-    j+=1
+        j+=1
 
 # print(tmp.size())
 # print(tmp.view(-1, 3, 48, 128).size())
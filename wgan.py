@@ -27,16 +27,18 @@ class WGANGP(GAN_base):
         interpolates = eps * real_data + (1 - eps) * fake_data
         interpolates = Variable(interpolates, requires_grad=True)
 
-        # push thorugh network
-        D_interpolates = netD(interpolates)
+        # push thorugh network, eagerly: the penalty needs a double backward
+        with self.eager():
+            D_interpolates = netD(interpolates)
 
-        # compute the gradients
-        grads = torch.ones(D_interpolates.size())
-        grads = grads.cuda() if real_data.is_cuda else grads
-        gradients = torch.autograd.grad(outputs=D_interpolates, inputs=interpolates, grad_outputs=grads,
-                                        create_graph=True, only_inputs=True)
+            # compute the gradients
+            grads = torch.ones(D_interpolates.size())
+            grads = grads.cuda() if real_data.is_cuda else grads
+            gradients = torch.autograd.grad(outputs=D_interpolates, inputs=interpolates, grad_outputs=grads,
+                                            create_graph=True, only_inputs=True)
 
-        gradient_input = gradients[0].view(batch_size, -1)
+        # float32 norms, also under bf16 autocast (see GAN_base.autocast)
+        gradient_input = gradients[0].float().view(batch_size, -1)
         
 
         # compute the penalties
@@ -53,6 +55,8 @@ class WGANGP(GAN_base):
         scores_b = self.netD(data_b)
         gradient_penalties = self.compute_gradient_penalties(self.netD, data_a.data, data_b.data)
 
+        scores_a, scores_b = scores_a.float(), scores_b.float()
+
         mean_dim = 0 if scores_a.dim() == 1 else 1
         gradient_penalty = gradient_penalties.mean(mean_dim)
         errD = scores_a.mean(mean_dim) - scores_b.mean(mean_dim) + self.wgangp_lambda * gradient_penalty
@@ -62,4 +66,4 @@ class WGANGP(GAN_base):
     def compute_gen_score(self, data):
         if self.opt.conditional:
             data = self.join_xy(data)
-        return self.netD(data).mean()
+        return self.netD(data).float().mean()